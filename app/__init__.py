@@ -1,56 +1,77 @@
 from flask import Flask
 from config import Config
 from flask_sqlalchemy  import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 from dotenv import load_dotenv
-import logging
-from logging.handlers import SMTPHandler,RotatingFileHandler
-import os
+from .replica import RoutingSession, replica_router
 
 
 
-app = Flask(__name__)
 load_dotenv()
-#app configuration
-app.config.from_object(Config)
-#data base object
-db = SQLAlchemy(app)
-#migration engine
-migrate = Migrate(app,db) 
-#login manager 
-login = LoginManager(app)
+#data base object , its session sends the reads of GET requests to the read replica when one is configured
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+#login manager
+login = LoginManager()
 #set the login view that the login manage will redirect to when login is required
-login.login_view = 'login'
-
-#import routes for different views , and models for the database models
-from . import routes,models,errors
-
-
-if not app.debug:
-    if app.config['EMAIL_SERVER']:
-        auth = None
-        if app.config['EMAIL_USERNAME'] or app.config['EMAIL_PASSWORD']:
-            auth =( app.config['EMAIL_USERNAME'],app.config['EMAIL_PASSWORD'])
-
-        secure = None
-        if app.config['EMAIL_USE_TLS']:
-            secure = ()
-        mail_handler = SMTPHandler(
-            mailhost=(app.config['EMAIL_SERVER'],app.config['EMAIL_PORT']),
-            fromaddr='no-reply@' + app.config['EMAIL_SERVER'],
-            toaddrs=app.config['ADMINS'],subject='Microblog Failure',
-            credentials=auth,secure=secure)
-        #this means only logs with a level of ERROR or higher will be sent
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
-
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/microblog.log',maxBytes=10240,backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler) 
-        app.logger.setLevel(logging.INFO)   
-        app.logger.info('Microblog startup')
\ No newline at end of file
+login.login_view = 'main.login'
+
+
+#application factory , the extensions are module level objects bound to the app by their init_app
+#nothing here opens a connection, the background threads (log listener, flushers, task workers) are started by each
+#process when it first needs them, so a preloaded master can fork its workers (see gunicorn.conf.py)
+def create_app(config_class=Config):
+    app = Flask(__name__)
+    #app configuration
+    app.config.from_object(config_class)
+    db.init_app(app)
+    replica_router.init_app(app, db)
+    #connection settings of the database profile
+    from .database import configure_engine
+    with app.app_context():
+        configure_engine(db.engine, app.config)
+    login.init_app(app)
+
+    #blueprints for the different views , the error pages , the json api and the cli commands
+    from .routes import bp as main_bp
+    app.register_blueprint(main_bp)
+    from .errors import bp as errors_bp
+    app.register_blueprint(errors_bp)
+    #json api for the mobile clients
+    from .api import bp as api_bp
+    app.register_blueprint(api_bp)
+    from .cli import bp as cli_bp, MigrateCommands
+    app.register_blueprint(cli_bp)
+    #migration commands , alembic is only imported when they run
+    app.cli.add_command(MigrateCommands())
+
+    from .last_seen import last_seen_buffer
+    last_seen_buffer.init_app(app)
+    models.user_cache.init_app(app)
+    models.followed_cache.init_app(app)
+    from .instrumentation import instrumentation
+    instrumentation.init_app(app)
+    instrumentation.add_collector(models.followed_cache, 'microblog_followed_cache')
+    from .fragments import fragment_cache
+    fragment_cache.init_app(app)
+    from .hashing import password_hasher
+    password_hasher.init_app(app)
+    from .response_cache import response_cache
+    response_cache.init_app(app)
+    from .search import search
+    search.init_app(app)
+    from .tasks import task_queue
+    task_queue.init_app(app)
+    #the timeline listeners and tasks
+    from . import timeline
+
+    if not app.debug and not app.testing:
+        #log records go through a queue , the file and the error mails are written by a background thread
+        from .log import log_pipeline
+        log_pipeline.init_app(app)
+        app.logger.info('Microblog startup')
+
+    return app
+
+
+#the models are needed by the flask-login user loader
+from . import models
@@ -0,0 +1,321 @@
+from datetime import datetime
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import current_user
+from sqlalchemy import and_, join, or_, select
+from . import db
+from .models import Post, User, avatar_url, followers, hash_email, timeline
+from .pagination import decode_key, encode_key
+from .timeline import TIMELINE_KEY, followed_celebrities
+
+# json api for the mobile clients, the same data as the html pages without the templates
+# the rows are read as tuples of only the columns of the requested fields (?fields=id,body,author)
+# and the lists are paginated on an indexed key, the next page is read with ?cursor=<next_cursor>
+#   GET  /api/v1/timeline                       home timeline of the logged in user
+#   GET  /api/v1/explore                        every post
+#   GET  /api/v1/users/<username>               profile
+#   GET  /api/v1/users/<username>/posts         posts of a user
+#   GET  /api/v1/users/<username>/followers     followers of a user
+#   GET  /api/v1/users/<username>/followed      users followed by a user
+#   POST /api/v1/batch                          {"users": {"ids": [...], "fields": [...]}, "posts": {"ids": [...]}}
+
+bp = Blueprint("api", __name__, url_prefix="/api/v1")
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Field:
+    def __init__(self, *columns, value=None, join=False):
+        self.columns = columns
+        # value of the field from the values of its columns, the value of the column by default
+        self.value = value
+        # the column is read from the table joined to the resource (the author of a post)
+        self.join = join
+
+
+class Resource:
+    def __init__(self, model, fields, default, key, descending=False, join=None):
+        # the model, or its join with the table holding its key (the materialized timeline)
+        self.model = model
+        self.fields = fields
+        self.default = default
+        # the ordering key of the lists, unique and indexed
+        self.key = key
+        self.descending = descending
+        self.join = join
+
+    def parse_fields(self, value):
+        if not value:
+            return self.default
+        names = value.split(",") if isinstance(value, str) else value
+        if not isinstance(names, list) or not all(
+            isinstance(name, str) for name in names
+        ):
+            raise ApiError(
+                "expected the fields as a comma separated string or a list of names"
+            )
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise ApiError(
+                f"unknown fields {', '.join(map(str, unknown))}, "
+                f"expected some of {', '.join(self.fields)}"
+            )
+        return list(dict.fromkeys(names))
+
+    def select(self, names):
+        # the query of the columns of the fields and of the key, with a serializer of its rows
+        fields = [self.fields[name] for name in names]
+        # columns compare with == to sql expressions, they are told apart by identity
+        positions = {id(column): i for i, column in enumerate(self.key)}
+        columns = list(self.key)
+        for field in fields:
+            for column in field.columns:
+                if id(column) not in positions:
+                    positions[id(column)] = len(columns)
+                    columns.append(column)
+        query = select(*columns).select_from(self.model)
+        if self.join is not None and any(field.join for field in fields):
+            query = query.join(*self.join)
+        getters = [
+            (name, field.value, [positions[id(column)] for column in field.columns])
+            for name, field in zip(names, fields)
+        ]
+
+        def serialize(row):
+            item = {}
+            for name, value, indexes in getters:
+                if value is None:
+                    item[name] = _json_value(row[indexes[0]])
+                else:
+                    item[name] = value(*(row[i] for i in indexes))
+            return item
+
+        return query, serialize
+
+    def encode_cursor(self, row):
+        return encode_key([_json_value(row[i]) for i in range(len(self.key))])
+
+    def decode_cursor(self, token):
+        try:
+            values = decode_key(token)
+            if len(values) != len(self.key):
+                raise ValueError(token)
+            return [
+                (
+                    datetime.fromisoformat(value.rstrip("Z"))
+                    if isinstance(column.type, db.DateTime)
+                    else int(value)
+                )
+                for column, value in zip(self.key, values)
+            ]
+        except (ValueError, TypeError, AttributeError):
+            raise ApiError(f"invalid cursor {token!r}")
+
+    def _past(self, values):
+        # (a, b) < (x, y) written out so that every database can use the index on the key
+        clauses = []
+        for i, column in enumerate(self.key):
+            equal = [self.key[j] == values[j] for j in range(i)]
+            past = column < values[i] if self.descending else column > values[i]
+            clauses.append(and_(*equal, past))
+        return or_(*clauses)
+
+    def page(self, where, names, cursor=None, limit=None):
+        query, serialize = self.select(names)
+        query = query.where(*where)
+        if cursor:
+            query = query.where(self._past(self.decode_cursor(cursor)))
+        order = [column.desc() if self.descending else column for column in self.key]
+        rows = db.session.execute(query.order_by(*order).limit(limit + 1)).all()
+        next_cursor = self.encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return {
+            "items": [serialize(row) for row in rows[:limit]],
+            "next_cursor": next_cursor,
+        }
+
+    def by_ids(self, ids, names):
+        # rows in the order of ids, the unknown ids are left out
+        query, serialize = self.select(names)
+        rows = db.session.execute(query.where(self.key[-1].in_(ids))).all()
+        found = {row[len(self.key) - 1]: serialize(row) for row in rows}
+        return [found[id] for id in dict.fromkeys(ids) if id in found]
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        # the time stamps are stored in utc
+        return value.isoformat() + "Z"
+    return value
+
+
+POSTS = Resource(
+    Post,
+    {
+        "id": Field(Post.id),
+        "body": Field(Post.body),
+        "time_stamp": Field(Post.time_stamp),
+        "author_id": Field(Post.user_id),
+        "author": Field(User.username, join=True),
+    },
+    default=["id", "body", "time_stamp", "author"],
+    key=[Post.time_stamp, Post.id],
+    descending=True,
+    join=(User, User.id == Post.user_id),
+)
+
+# the materialized home timeline is paged on the copy of the (time_stamp, id) key of its posts,
+# which ix_timeline_user_id_time_stamp returns in order, the cursors are the same as the ones of POSTS
+TIMELINE_POSTS = Resource(
+    join(Post, timeline, timeline.c.post_id == Post.id),
+    POSTS.fields,
+    default=POSTS.default,
+    key=list(TIMELINE_KEY),
+    descending=True,
+    join=POSTS.join,
+)
+
+USERS = Resource(
+    User,
+    {
+        "id": Field(User.id),
+        "username": Field(User.username),
+        "about_me": Field(User.about_me),
+        "last_seen": Field(User.last_seen),
+        "avatar": Field(
+            User.email_hash,
+            User.email,
+            value=lambda email_hash, email: avatar_url(
+                email_hash or hash_email(email), 128
+            ),
+        ),
+        "posts_count": Field(User.posts_count),
+        "followers_count": Field(User.followers_count),
+        "followed_count": Field(User.followed_count),
+    },
+    default=["id", "username", "avatar"],
+    key=[User.id],
+)
+
+
+@bp.errorhandler(ApiError)
+def api_error(error):
+    return jsonify(error=error.message), error.status
+
+
+@bp.before_request
+def require_login():
+    # same access as the html pages : only the explore page is public
+    if request.endpoint != "api.explore" and not current_user.is_authenticated:
+        raise ApiError("authentication required", 401)
+
+
+def _limit():
+    limit = request.args.get("limit", current_app.config["API_PER_PAGE"], type=int)
+    return max(1, min(limit, current_app.config["API_MAX_PER_PAGE"]))
+
+
+def _page(resource, *where):
+    return jsonify(
+        resource.page(
+            where,
+            resource.parse_fields(request.args.get("fields")),
+            request.args.get("cursor"),
+            _limit(),
+        )
+    )
+
+
+def _user_id(username):
+    id = db.session.execute(select(User.id).where(User.username == username)).scalar()
+    if id is None:
+        raise ApiError(f"unknown user {username!r}", 404)
+    return id
+
+
+def _home_timeline(user):
+    # the resource and the filter of the home timeline of user
+    if current_app.config["TIMELINE_MATERIALIZED"]:
+        celebrities = db.session.execute(followed_celebrities(user)).scalars().all()
+        if not celebrities:
+            return TIMELINE_POSTS, timeline.c.user_id == user.id
+        # the posts of the celebrities are merged at read time, like in timeline_page
+        pushed = select(timeline.c.post_id).where(timeline.c.user_id == user.id)
+        return POSTS, or_(Post.id.in_(pushed), Post.user_id.in_(celebrities))
+    followed = select(followers.c.followed_id).where(followers.c.follower_id == user.id)
+    return POSTS, or_(Post.user_id.in_(followed), Post.user_id == user.id)
+
+
+@bp.route("/timeline")
+def home_timeline():
+    return _page(*_home_timeline(current_user))
+
+
+@bp.route("/explore")
+def explore():
+    return _page(POSTS)
+
+
+@bp.route("/users/<username>")
+def user(username):
+    names = USERS.parse_fields(request.args.get("fields"))
+    query, serialize = USERS.select(names)
+    row = db.session.execute(query.where(User.username == username)).first()
+    if row is None:
+        raise ApiError(f"unknown user {username!r}", 404)
+    return jsonify(serialize(row))
+
+
+@bp.route("/users/<username>/posts")
+def user_posts(username):
+    return _page(POSTS, Post.user_id == _user_id(username))
+
+
+@bp.route("/users/<username>/followers")
+def user_followers(username):
+    followed = select(followers.c.follower_id).where(
+        followers.c.followed_id == _user_id(username)
+    )
+    return _page(USERS, User.id.in_(followed))
+
+
+@bp.route("/users/<username>/followed")
+def user_followed(username):
+    followed = select(followers.c.followed_id).where(
+        followers.c.follower_id == _user_id(username)
+    )
+    return _page(USERS, User.id.in_(followed))
+
+
+@bp.route("/batch", methods=["POST"])
+def batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not set(data) <= {"users", "posts"}:
+        raise ApiError('expected a json object with "users" and/or "posts"')
+    requests = {}
+    for kind, resource in (("users", USERS), ("posts", POSTS)):
+        if kind not in data:
+            continue
+        spec = data[kind]
+        ids = spec.get("ids") if isinstance(spec, dict) else None
+        if not isinstance(ids, list) or not all(
+            isinstance(id, int) and not isinstance(id, bool) for id in ids
+        ):
+            raise ApiError(f'expected a list of integer ids in "{kind}"')
+        requests[kind] = (resource, ids, resource.parse_fields(spec.get("fields")))
+    if (
+        sum(len(ids) for _, ids, _ in requests.values())
+        > current_app.config["API_BATCH_MAX"]
+    ):
+        raise ApiError(
+            f"at most {current_app.config['API_BATCH_MAX']} ids per request", 413
+        )
+    return jsonify(
+        {
+            kind: resource.by_ids(ids, names)
+            for kind, (resource, ids, names) in requests.items()
+        }
+    )
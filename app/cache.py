@@ -0,0 +1,268 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import make_transient_to_detached
+from . import db
+
+# cache backends share the same small interface : get(key), set(key, value), delete(key), clear()
+
+
+class LRUCache:
+    # in-process cache bounded to maxsize entries, the least recently used entry is evicted first
+    # entries older than ttl seconds are treated as missing (ttl=None keeps them until evicted)
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class RedisCache:
+    # cache shared between the workers, needs the optional redis package
+
+    def __init__(self, url, prefix="microblog:", ttl=None):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        value = self.client.get(f"{self.prefix}{key}")
+        return pickle.loads(value) if value is not None else default
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self.client.set(f"{self.prefix}{key}", pickle.dumps(value), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(f"{self.prefix}{key}")
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f"{self.prefix}*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+def make_cache(url, prefix, maxsize, ttl):
+    if url:
+        return RedisCache(url, prefix=prefix, ttl=ttl)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
+
+
+class ModelCache:
+    # caches the column values of model instances by primary key
+    # a cached row is attached to the session with merge(load=False) so getting it costs no database round trip
+    # rows changed by a flush are dropped from the cache once the transaction commits
+    # the backend is configured by the <NAME>_CACHE_URL, <NAME>_CACHE_SIZE and <NAME>_CACHE_TTL settings
+
+    def __init__(self, model, name, app=None):
+        self.model = model
+        self.name = name
+        self.prefix = f"{name}:"
+        self.backend = LRUCache()
+        self._columns = [attr.key for attr in inspect(model).column_attrs]
+        event.listen(db.session, "after_flush", self._collect_changes)
+        event.listen(db.session, "after_commit", self._invalidate_changes)
+        event.listen(db.session, "after_rollback", self._discard_changes)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        setting = self.name.upper() + "_CACHE_"
+        self.backend = make_cache(
+            app.config[setting + "URL"],
+            self.prefix,
+            app.config[setting + "SIZE"],
+            app.config[setting + "TTL"],
+        )
+
+    def get(self, id):
+        values = self.backend.get(id)
+        if values is None:
+            # read from the primary so a lagging replica never fills the cache with an old row
+            instance = db.session.get(
+                self.model, id, bind_arguments={"bind": db.engine}
+            )
+            if instance is not None:
+                self.backend.set(id, self._snapshot(instance))
+            return instance
+        instance = self.model(**values)
+        make_transient_to_detached(instance)
+        return db.session.merge(instance, load=False)
+
+    def invalidate(self, id):
+        self.backend.delete(id)
+
+    def changed(self, session, id):
+        # for rows updated behind the back of the orm, they are dropped from the cache when session commits
+        session.info.setdefault(self.prefix, set()).add(id)
+
+    def _snapshot(self, instance):
+        return {key: getattr(instance, key) for key in self._columns}
+
+    def _collect_changes(self, session, flush_context):
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, self.model) and instance.id is not None:
+                self.changed(session, instance.id)
+
+    def _invalidate_changes(self, session):
+        for id in session.info.pop(self.prefix, ()):
+            self.invalidate(id)
+
+    def _discard_changes(self, session):
+        session.info.pop(self.prefix, None)
+
+
+class AdjacencyCache:
+    # caches the neighbours of a node of a graph table, e.g. the ids followed by a user, as a frozenset
+    # so a membership test is a set lookup and the degree is len()
+    # nodes with more than max_degree neighbours are not cached, they are answered by the database
+    # like ModelCache, the nodes changed in a transaction are read from the database until it commits and dropped then
+    # the backend is configured by the <NAME>_CACHE_URL, <NAME>_CACHE_SIZE and <NAME>_CACHE_TTL settings
+
+    def __init__(self, source, target, name, app=None):
+        self.source = source
+        self.target = target
+        self.name = name
+        self.prefix = f"{name}:"
+        self.backend = LRUCache()
+        self.max_degree = None
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self._lock = threading.Lock()
+        event.listen(db.session, "after_commit", self._invalidate_changes)
+        event.listen(db.session, "after_rollback", self._discard_changes)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        setting = self.name.upper() + "_CACHE_"
+        self.backend = make_cache(
+            app.config[setting + "URL"],
+            self.prefix,
+            app.config[setting + "SIZE"],
+            app.config[setting + "TTL"],
+        )
+        self.max_degree = app.config[setting + "MAX_DEGREE"]
+
+    def neighbours(self, node):
+        # the set of neighbours or None when the node has too many of them to be cached
+        if node in db.session.info.get(self.prefix, ()):
+            # core selects are not autoflushed, the pending changes are sent first
+            db.session.flush()
+            return self._load(node)
+        neighbours = self.backend.get(node)
+        if neighbours is not None:
+            self._count("hits")
+            return neighbours
+        self._count("misses")
+        neighbours = self._load(node)
+        if neighbours is not None:
+            self.backend.set(node, neighbours)
+        return neighbours
+
+    def contains(self, node, neighbour):
+        neighbours = self.neighbours(node)
+        if neighbours is None:
+            self._count("uncached")
+            query = select(self.target).where(
+                self.source == node, self.target == neighbour
+            )
+            return db.session.execute(query.exists().select()).scalar()
+        return neighbour in neighbours
+
+    def changed(self, session, node):
+        session.info.setdefault(self.prefix, set()).add(node)
+
+    def invalidate(self, node):
+        self.backend.delete(node)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "uncached": self.uncached,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": (
+                    len(self.backend) if isinstance(self.backend, LRUCache) else None
+                ),
+            }
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _load(self, node):
+        # read from the primary so a lagging replica never fills the cache with an old graph
+        query = select(self.target).where(self.source == node)
+        if self.max_degree is not None:
+            query = query.limit(self.max_degree + 1)
+        rows = (
+            db.session.execute(query, bind_arguments={"bind": db.engine})
+            .scalars()
+            .all()
+        )
+        if self.max_degree is not None and len(rows) > self.max_degree:
+            return None
+        return frozenset(rows)
+
+    def _invalidate_changes(self, session):
+        for node in session.info.pop(self.prefix, ()):
+            self.invalidate(node)
+
+    def _discard_changes(self, session):
+        session.info.pop(self.prefix, None)
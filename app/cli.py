@@ -0,0 +1,186 @@
+import csv
+import json
+import threading
+import click
+from flask import Blueprint, current_app
+from sqlalchemy import select
+from . import db
+from . import timeline
+from .models import User, follow_pairs, rebuild_counters
+from .export import EXPORTS, ExportError, export, parse_since
+from .search import search
+from .tasks import task_queue
+
+bp = Blueprint("cli", __name__, cli_group=None)
+
+
+class MigrateCommands(click.Group):
+    # "flask db", alembic is imported when a migration command runs instead of by every web worker
+    def __init__(self):
+        super().__init__("db", help="Perform database migrations.")
+
+    def _group(self):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as migrate_commands
+
+        app = current_app._get_current_object()
+        if "migrate" not in app.extensions:
+            Migrate(app, db)
+        return migrate_commands
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # the context of flask-migrate's group, which runs the command
+        return self._group().make_context(info_name, args, parent=parent, **extra)
+
+    def list_commands(self, ctx):
+        return self._group().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._group().get_command(ctx, name)
+
+
+@bp.cli.group("timeline")
+def timeline_commands():
+    """Materialized home timeline commands."""
+    pass
+
+
+@timeline_commands.command()
+def rebuild():
+    """Recompute every user's home timeline from the posts and the follow graph."""
+    timeline.rebuild()
+    click.echo("Timelines rebuilt")
+
+
+@bp.cli.group("counters")
+def counters_commands():
+    """Denormalized user counters commands."""
+    pass
+
+
+@counters_commands.command("rebuild")
+def rebuild_counters_command():
+    """Recompute the followers, followed and posts counters of every user."""
+    rebuild_counters()
+    click.echo("Counters rebuilt")
+
+
+@bp.cli.group("follows")
+def follows_commands():
+    """Follow graph commands."""
+    pass
+
+
+def _read_follows(file, format):
+    # yields (follower, followed) usernames one line at a time so the file is never loaded whole
+    if format == "csv":
+        for row in csv.DictReader(file):
+            yield row["follower"], row["followed"]
+    else:
+        for line in file:
+            if line.strip():
+                row = json.loads(line)
+                yield row["follower"], row["followed"]
+
+
+def _import_batch(batch):
+    # resolves the usernames of the batch with one query and inserts its edges
+    usernames = {username for pair in batch for username in pair}
+    ids = dict(
+        db.session.execute(
+            select(User.username, User.id).where(User.username.in_(usernames))
+        ).all()
+    )
+    pairs = [(ids[a], ids[b]) for a, b in batch if a in ids and b in ids]
+    follow_pairs(pairs)
+    db.session.commit()
+    return len(pairs), len(batch) - len(pairs)
+
+
+@follows_commands.command("import")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option(
+    "--format",
+    type=click.Choice(["csv", "jsonl"]),
+    help="Defaults to the extension of the file.",
+)
+@click.option("--batch-size", default=1000, show_default=True)
+def import_follows(file, format, batch_size):
+    """Import follower,followed username pairs from a CSV or JSON lines file."""
+    if format is None:
+        format = "jsonl" if file.name.endswith((".jsonl", ".json")) else "csv"
+    imported = skipped = 0
+    batch = []
+    for pair in _read_follows(file, format):
+        batch.append(pair)
+        if len(batch) >= batch_size:
+            done, unknown = _import_batch(batch)
+            imported, skipped = imported + done, skipped + unknown
+            batch = []
+    if batch:
+        done, unknown = _import_batch(batch)
+        imported, skipped = imported + done, skipped + unknown
+    click.echo(f"Imported {imported} follows, skipped {skipped} with unknown users")
+
+
+@bp.cli.command("export")
+@click.argument("kind", type=click.Choice(sorted(EXPORTS)))
+@click.option("--format", type=click.Choice(["jsonl", "csv"]), default="jsonl")
+@click.option(
+    "--output", type=click.File("w", encoding="utf-8", lazy=True), default="-"
+)
+@click.option("--after", help="Cursor of the last row of a previous export.")
+@click.option("--since", help="Only the posts written since this ISO 8601 time stamp.")
+@click.option("--batch-size", default=1000, show_default=True)
+def export_command(kind, format, output, after, since, batch_size):
+    """Export the posts or the users as JSON lines or CSV."""
+    try:
+        chunks = export(kind, format, after, parse_since(since), batch_size)
+    except ExportError as error:
+        raise click.UsageError(str(error))
+    for chunk in chunks:
+        output.write(chunk)
+
+
+@bp.cli.group("search")
+def search_commands():
+    """Full text search commands."""
+    pass
+
+
+@search_commands.command()
+def reindex():
+    """Rebuild the search index from every post."""
+    with db.engine.begin() as connection:
+        search.backend.create(connection)
+        search.backend.rebuild(connection)
+    click.echo("Search index rebuilt")
+
+
+@bp.cli.command("worker")
+@click.option("--threads", default=1, show_default=True)
+@click.option("--burst", is_flag=True, help="Exit once the queue is empty.")
+def worker(threads, burst):
+    """Run the background jobs of the task queue."""
+    if task_queue.backend is None:
+        raise click.UsageError("TASK_QUEUE is inline, there is no queue to consume")
+    if current_app.config["TASK_QUEUE"] == "memory":
+        raise click.UsageError(
+            "the memory queue lives in the web process, set TASK_QUEUE=sqlite"
+        )
+    # the threads have no app context of their own
+    app = current_app._get_current_object()
+    workers = [
+        threading.Thread(target=task_queue.work, kwargs={"burst": burst, "app": app})
+        for _ in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    try:
+        for thread in workers:
+            thread.join()
+    except KeyboardInterrupt:
+        task_queue.stop()
+        for thread in workers:
+            thread.join()
+    click.echo("Worker stopped")
@@ -0,0 +1,75 @@
+import hashlib
+import time
+from datetime import timezone
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from .models import Post
+
+# conditional GET for the post listing pages
+# the ETag is computed from cheap indexed lookups (the newest post in scope, versions of the users shown)
+# so that a client that already has the page gets a 304 before any pagination query or template rendering,
+# explore shows the posts of many authors, its ETag is made from the posts of the page it reads once
+
+
+def newest_post(query):
+    # (time_stamp, id) of the newest post of the query, read from the time_stamp indexes
+    return (
+        query.with_entities(Post.time_stamp, Post.id)
+        .order_by(Post.time_stamp.desc(), Post.id.desc())
+        .first()
+    )
+
+
+def page_authors(posts):
+    # (post id, author id, author profile_version) of the posts shown, renaming an author
+    # changes the page as much as a new post does
+    return tuple((post.id, post.user_id, post.author.profile_version) for post in posts)
+
+
+def page_etag(*parts):
+    # the page also depends on who is looking at it and on its query string
+    if current_user.is_authenticated:
+        viewer = (current_user.id, current_user.profile_version)
+    else:
+        viewer = "anonymous"
+    key = repr((request.endpoint, request.query_string, viewer) + parts)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def csrf_period():
+    # pages with a form embed a csrf token, they must be rendered again before the token expires
+    limit = current_app.config.get("WTF_CSRF_TIME_LIMIT") or 3600
+    return int(time.time() // (limit / 2))
+
+
+def _set_cache_headers(response, etag, last_modified, public):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    if public:
+        # anonymous pages can be stored by a shared cache such as a reverse proxy
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config["PUBLIC_PAGE_MAX_AGE"]
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+def _not_modified(etag, last_modified, public):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    # If-Modified-Since only says something about the posts, it is only trusted for the public pages
+    if public and last_modified is not None and request.if_modified_since:
+        return request.if_modified_since >= last_modified.replace(
+            tzinfo=timezone.utc, microsecond=0
+        )
+    return False
+
+
+def conditional_page(etag, last_modified, render, public=False):
+    # flashed messages are part of the page and are consumed by the rendering, they always get a full response
+    if "_flashes" not in session and _not_modified(etag, last_modified, public):
+        return _set_cache_headers(make_response("", 304), etag, last_modified, public)
+    return _set_cache_headers(make_response(render()), etag, last_modified, public)
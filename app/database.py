@@ -0,0 +1,32 @@
+from sqlalchemy import event
+
+# database connection profile
+# with DATABASE_PROFILE=production every new sqlite connection is switched to write ahead logging, so readers
+# never wait for the writer and the writer does not wait for the readers, with synchronous=NORMAL so a commit
+# only syncs at checkpoints, a busy timeout so concurrent writers queue instead of failing with "database is locked",
+# and a memory map and page cache sized for the hot tables
+# the server databases are tuned with the pool options of SQLALCHEMY_ENGINE_OPTIONS instead
+
+
+def sqlite_pragmas(config):
+    return [
+        ("journal_mode", config["SQLITE_JOURNAL_MODE"]),
+        ("synchronous", config["SQLITE_SYNCHRONOUS"]),
+        ("busy_timeout", config["SQLITE_BUSY_TIMEOUT_MS"]),
+        ("mmap_size", config["SQLITE_MMAP_SIZE"]),
+        # a negative cache size is in KiB instead of pages
+        ("cache_size", -config["SQLITE_CACHE_SIZE_KB"]),
+    ]
+
+
+def configure_engine(engine, config):
+    if engine.dialect.name != "sqlite" or config["DATABASE_PROFILE"] != "production":
+        return
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
@@ -0,0 +1,148 @@
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import DateTime, and_, or_, select
+from . import db
+from .models import Post, User
+from .pagination import decode_key, encode_key
+
+# bulk export of the posts and users for backups and analytics feeds
+# the rows are read in batches ordered on a unique key and each batch starts after the last key of the previous one,
+# so every batch is an index range scan whatever the depth and only one batch is held in memory
+# every row carries the cursor of its key, an interrupted export is resumed with after=<cursor of the last row>
+
+
+class ExportError(ValueError):
+    pass
+
+
+class Export:
+    def __init__(self, columns, key, since=None):
+        self.columns = columns
+        # the ordering key, unique and indexed
+        self.key = key
+        # the column compared with since= for the incremental exports
+        self.since = since
+
+    @property
+    def fields(self):
+        return [column.key for column in self.columns] + ["cursor"]
+
+    def encode_cursor(self, row):
+        values = [getattr(row, column.key) for column in self.key]
+        return encode_key(
+            [v.isoformat() if isinstance(v, datetime) else v for v in values]
+        )
+
+    def decode_cursor(self, token):
+        try:
+            values = decode_key(token)
+            if len(values) != len(self.key):
+                raise ValueError(token)
+            return [
+                (
+                    datetime.fromisoformat(value)
+                    if isinstance(column.type, DateTime)
+                    else int(value)
+                )
+                for column, value in zip(self.key, values)
+            ]
+        except (ValueError, TypeError):
+            raise ExportError(f"invalid cursor {token!r}")
+
+    def _after(self, values):
+        # (a, b) > (x, y) written out so that every database can use the index on the key
+        clauses = []
+        for i, column in enumerate(self.key):
+            equal = [self.key[j] == values[j] for j in range(i)]
+            clauses.append(and_(*equal, column > values[i]))
+        return or_(*clauses)
+
+    def batches(self, after=None, since=None, batch_size=1000):
+        # yields lists of rows as dicts, the last key of a batch is the start of the next one
+        query = select(*self.columns).order_by(*self.key).limit(batch_size)
+        if since is not None:
+            query = query.where(self.since >= since)
+        last = self.decode_cursor(after) if after else None
+        while True:
+            batch = query if last is None else query.where(self._after(last))
+            rows = db.session.execute(batch).all()
+            if not rows:
+                return
+            yield [dict(row._mapping, cursor=self.encode_cursor(row)) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last = [getattr(rows[-1], column.key) for column in self.key]
+
+
+EXPORTS = {
+    "posts": Export(
+        [Post.id, Post.user_id, Post.body, Post.time_stamp],
+        key=[Post.time_stamp, Post.id],
+        since=Post.time_stamp,
+    ),
+    # the password hashes are never exported
+    "users": Export(
+        [
+            User.id,
+            User.username,
+            User.email,
+            User.about_me,
+            User.last_seen,
+            User.followers_count,
+            User.followed_count,
+            User.posts_count,
+        ],
+        key=[User.id],
+    ),
+}
+
+MIMETYPES = {"jsonl": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(value)
+
+
+def encode(batches, format, fields):
+    # one text chunk per batch
+    if format == "jsonl":
+        for rows in batches:
+            yield "".join(json.dumps(row, default=_json_default) + "\n" for row in rows)
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def parse_since(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ExportError(f"invalid since {value!r}, expected an ISO 8601 time stamp")
+
+
+def export(kind, format="jsonl", after=None, since=None, batch_size=1000):
+    # text chunks of the export, checked before the first batch is read
+    if kind not in EXPORTS:
+        raise ExportError(f"unknown export {kind!r}")
+    if format not in MIMETYPES:
+        raise ExportError(f"unknown format {format!r}")
+    exporter = EXPORTS[kind]
+    if since is not None and exporter.since is None:
+        raise ExportError(f"{kind} can not be exported since a time stamp")
+    if after:
+        exporter.decode_cursor(after)
+    return encode(exporter.batches(after, since, batch_size), format, exporter.fields)
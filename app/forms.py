@@ -1,3 +1,4 @@
+from flask import request
 from flask_wtf import FlaskForm
 from wtforms import StringField, BooleanField, PasswordField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length
@@ -58,5 +59,15 @@ class PostForm(FlaskForm):
     sumbit = SubmitField("Post")
 
 
+# the search form is submitted with GET, its data is read from the query string and it has no csrf token
+class SearchForm(FlaskForm):
+    q = StringField("Search", validators=[DataRequired()])
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("formdata", request.args)
+        kwargs.setdefault("meta", {"csrf": False})
+        super(SearchForm, self).__init__(*args, **kwargs)
+
+
 class EmptyForm(FlaskForm):
     submit = SubmitField("Submit")
@@ -0,0 +1,30 @@
+from flask import render_template
+from markupsafe import Markup
+from .cache import LRUCache
+
+# cache of the rendered _post.html blocks
+# a block only shows the post and its author, so it is keyed on (post id, author id, author profile version) :
+# an edit of the profile bumps the version and the blocks rendered with the old author are never read again,
+# they are evicted by the LRU bound like any other cold entry
+
+
+class FragmentCache:
+    def __init__(self, app=None):
+        self.cache = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = LRUCache(maxsize=app.config["FRAGMENT_CACHE_SIZE"])
+        app.add_template_global(self.render_post)
+
+    def render_post(self, post):
+        key = (post.id, post.user_id, post.author.profile_version)
+        html = self.cache.get(key)
+        if html is None:
+            html = Markup(render_template("_post.html", post=post))
+            self.cache.set(key, html)
+        return html
+
+
+fragment_cache = FragmentCache()
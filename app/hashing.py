@@ -0,0 +1,90 @@
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# password hashing runs in a dedicated process pool so a burst of logins does not pin the web workers on cpu
+# at most HASH_POOL_WORKERS hashes run at a time and HASH_QUEUE_DEPTH more can wait,
+# past that HashingBusy is raised right away and the request gets a 503 with Retry-After
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # the pool is shared by the apps of the process, its size is read from the app that starts it
+        atexit.register(self.shutdown)
+
+    @property
+    def method(self):
+        return current_app.config["PASSWORD_HASH_METHOD"]
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                workers = current_app.config["HASH_POOL_WORKERS"]
+                self._slots = threading.BoundedSemaphore(
+                    workers + current_app.config["HASH_QUEUE_DEPTH"]
+                )
+                # spawn so the workers do not inherit the threads and locks of the web process
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor, self._slots
+
+    def run(self, function, *args):
+        if not current_app.config["HASH_POOL_WORKERS"]:
+            return function(*args)
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = executor.submit(function, *args)
+            return future.result(timeout=current_app.config["HASH_TIMEOUT"])
+        except FutureTimeoutError:
+            future.cancel()
+            raise HashingBusy()
+        except BrokenProcessPool:
+            # a pool process died (killed, crashed), the pool stays broken so the next call starts a new one
+            self._discard(executor)
+            raise HashingBusy()
+        finally:
+            slots.release()
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def generate(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, hashed_password, password):
+        return self.run(check_password_hash, hashed_password, password)
+
+    def needs_rehash(self, hashed_password):
+        # hashes made with other parameters than PASSWORD_HASH_METHOD are replaced at the next login
+        return not hashed_password.startswith(self.method + "$")
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+password_hasher = PasswordHasher()
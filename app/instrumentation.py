@@ -0,0 +1,264 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import abort, current_app, g, has_request_context, request
+from flask import template_rendered
+from flask import before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# opt-in per request instrumentation, enabled with INSTRUMENTATION_ENABLED
+# every request records its sql queries, sql time, slow statements, template render time and password hashing time,
+# they are sent back as a Server-Timing header, logged as a json line and aggregated for the /metrics endpoint
+
+# upper bounds in seconds of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _current():
+    # the timings of the current request or None when the request is not instrumented
+    if has_request_context():
+        return g.get("_timings")
+    return None
+
+
+@contextmanager
+def timed(name):
+    # adds the time spent in the block to the given timing of the current request
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _current()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.durations = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.counts = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.sql = defaultdict(float)
+        self.render = defaultdict(float)
+        self.hash = defaultdict(float)
+        self.slow_queries = defaultdict(int)
+
+    def record(self, endpoint, method, status, timings, total):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.durations[endpoint] += total
+            self.counts[endpoint] += 1
+            buckets = self.buckets[endpoint]
+            for i, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    buckets[i] += 1
+            self.queries[endpoint] += timings["queries"]
+            self.sql[endpoint] += timings["sql"]
+            self.render[endpoint] += timings.get("render", 0.0)
+            self.hash[endpoint] += timings.get("hash", 0.0)
+            self.slow_queries[endpoint] += len(timings["slow"])
+
+    def render_prometheus(self):
+        # prometheus text exposition format
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{name}{suffix}{{{text}}} {value}")
+
+        with self._lock:
+            family(
+                "microblog_requests_total",
+                "counter",
+                "Requests handled.",
+                [
+                    ("", (("endpoint", e), ("method", m), ("status", s)), n)
+                    for (e, m, s), n in sorted(self.requests.items())
+                ],
+            )
+            histogram = []
+            for endpoint, buckets in sorted(self.buckets.items()):
+                for bound, n in zip(BUCKETS, buckets):
+                    histogram.append(
+                        ("_bucket", (("endpoint", endpoint), ("le", bound)), n)
+                    )
+                count = self.counts[endpoint]
+                histogram.append(
+                    ("_bucket", (("endpoint", endpoint), ("le", "+Inf")), count)
+                )
+                histogram.append(
+                    ("_sum", (("endpoint", endpoint),), self.durations[endpoint])
+                )
+                histogram.append(("_count", (("endpoint", endpoint),), count))
+            family(
+                "microblog_request_duration_seconds",
+                "histogram",
+                "Request duration.",
+                histogram,
+            )
+            for name, help, values in (
+                ("microblog_sql_queries_total", "SQL queries executed.", self.queries),
+                (
+                    "microblog_sql_duration_seconds_total",
+                    "Time spent in SQL.",
+                    self.sql,
+                ),
+                (
+                    "microblog_render_duration_seconds_total",
+                    "Time spent rendering templates.",
+                    self.render,
+                ),
+                (
+                    "microblog_password_hash_seconds_total",
+                    "Time spent hashing passwords.",
+                    self.hash,
+                ),
+                (
+                    "microblog_slow_queries_total",
+                    "SQL queries slower than SLOW_QUERY_MS.",
+                    self.slow_queries,
+                ),
+            ):
+                family(
+                    name,
+                    "counter",
+                    help,
+                    [("", (("endpoint", e),), v) for e, v in sorted(values.items())],
+                )
+        return "\n".join(lines) + "\n"
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self.metrics = Metrics()
+        self.collectors = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # the hooks are always installed and check INSTRUMENTATION_ENABLED on each request
+        # runs before the other before_request functions so that their queries are counted too
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start_request)
+        app.after_request(self._finish_request)
+        # the engine hooks are global, they are installed once for all the apps
+        if not event.contains(Engine, "before_cursor_execute", self._start_query):
+            event.listen(Engine, "before_cursor_execute", self._start_query)
+            event.listen(Engine, "after_cursor_execute", self._finish_query)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+    def add_collector(self, source, name):
+        # the values of source.stats() are exposed as <name>_<key> gauges, e.g. the hit rate of a cache
+        if (name, source) not in self.collectors:
+            self.collectors.append((name, source))
+
+    def _collect(self):
+        lines = []
+        for name, source in self.collectors:
+            for key, value in source.stats().items():
+                if value is not None:
+                    lines.append(f"# TYPE {name}_{key} gauge")
+                    lines.append(f"{name}_{key} {value}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def _start_request(self):
+        if current_app.config["INSTRUMENTATION_ENABLED"]:
+            g._timings = {
+                "start": time.perf_counter(),
+                "queries": 0,
+                "sql": 0.0,
+                "slow": [],
+                "renders": [],
+            }
+
+    def _start_query(self, conn, cursor, statement, parameters, context, executemany):
+        timings = _current()
+        if timings is not None:
+            conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _finish_query(self, conn, cursor, statement, parameters, context, executemany):
+        timings = _current()
+        if timings is None or not conn.info.get("query_start"):
+            return
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        timings["queries"] += 1
+        timings["sql"] += elapsed
+        if elapsed * 1000 >= current_app.config["SLOW_QUERY_MS"]:
+            timings["slow"].append(
+                {"statement": statement, "ms": round(elapsed * 1000, 3)}
+            )
+
+    def _start_render(self, sender, template, context, **extra):
+        timings = _current()
+        if timings is not None:
+            timings["renders"].append(time.perf_counter())
+
+    def _finish_render(self, sender, template, context, **extra):
+        timings = _current()
+        if timings is None or not timings["renders"]:
+            return
+        start = timings["renders"].pop()
+        # templates rendered from inside another template are already part of its time
+        if not timings["renders"]:
+            timings["render"] = timings.get("render", 0.0) + time.perf_counter() - start
+
+    def _finish_request(self, response):
+        timings = _current()
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings["start"]
+        endpoint = request.endpoint or "unknown"
+        response.headers["Server-Timing"] = ", ".join(
+            [
+                f'sql;dur={timings["sql"] * 1000:.2f};desc="{timings["queries"]} queries"',
+                f'render;dur={timings.get("render", 0.0) * 1000:.2f}',
+                f'hash;dur={timings.get("hash", 0.0) * 1000:.2f}',
+                f"total;dur={total * 1000:.2f}",
+            ]
+        )
+        self.metrics.record(
+            endpoint, request.method, response.status_code, timings, total
+        )
+        current_app.logger.info(
+            json.dumps(
+                {
+                    "event": "request",
+                    "method": request.method,
+                    "path": request.path,
+                    "endpoint": endpoint,
+                    "status": response.status_code,
+                    "total_ms": round(total * 1000, 3),
+                    "queries": timings["queries"],
+                    "sql_ms": round(timings["sql"] * 1000, 3),
+                    "render_ms": round(timings.get("render", 0.0) * 1000, 3),
+                    "hash_ms": round(timings.get("hash", 0.0) * 1000, 3),
+                }
+            )
+        )
+        for query in timings["slow"]:
+            current_app.logger.warning(
+                json.dumps({"event": "slow_query", "endpoint": endpoint, **query})
+            )
+        return response
+
+    def metrics_view(self):
+        if not current_app.config["INSTRUMENTATION_ENABLED"]:
+            abort(404)
+        return (
+            self.metrics.render_prometheus() + self._collect(),
+            200,
+            {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+
+instrumentation = Instrumentation()
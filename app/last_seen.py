@@ -0,0 +1,109 @@
+import atexit
+import threading
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import update
+from . import db
+from .models import User
+
+# write-behind buffer for User.last_seen
+# requests only record the time in memory, the values are coalesced per user and written with one bulk UPDATE
+# by a background thread every LAST_SEEN_FLUSH_INTERVAL seconds or as soon as LAST_SEEN_FLUSH_SIZE users are pending
+# every app has its own buffer and flusher thread in app.extensions, the thread keeps the app it writes with
+
+
+class _Buffer:
+    def __init__(self, app):
+        self.app = app
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+class LastSeenBuffer:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["last_seen"] = _Buffer(app)
+        atexit.register(self.stop, app)
+
+    def _buffer(self, app=None):
+        return (app or current_app).extensions["last_seen"]
+
+    def touch(self, user_id, when=None):
+        buffer = self._buffer()
+        with buffer.lock:
+            buffer.pending[user_id] = when or datetime.utcnow()
+            full = len(buffer.pending) >= current_app.config["LAST_SEEN_FLUSH_SIZE"]
+        if current_app.config["LAST_SEEN_FLUSH_INTERVAL"]:
+            self._start(buffer)
+            if full:
+                buffer.wakeup.set()
+        elif full:
+            # without a flusher thread the request that fills the buffer writes it
+            self.flush()
+
+    def get(self, user_id):
+        buffer = self._buffer()
+        with buffer.lock:
+            return buffer.pending.get(user_id)
+
+    def last_seen(self, user):
+        # read-through overlay : the buffered value is newer than the one stored in the database
+        return self.get(user.id) or user.last_seen
+
+    def flush(self, app=None):
+        buffer = self._buffer(app)
+        with buffer.lock:
+            pending, buffer.pending = buffer.pending, {}
+        if not pending:
+            return 0
+        rows = [{"id": id, "last_seen": when} for id, when in pending.items()]
+        try:
+            # a new app context gets its own session so the flush never commits the work of a request
+            with buffer.app.app_context():
+                db.session.execute(update(User), rows)
+                db.session.commit()
+        except Exception:
+            with buffer.lock:
+                for id, when in pending.items():
+                    buffer.pending.setdefault(id, when)
+            buffer.app.logger.exception("Could not flush the last seen times")
+            return 0
+        return len(rows)
+
+    def _start(self, buffer):
+        if buffer.thread is not None or buffer.stopped.is_set():
+            return
+        with buffer.lock:
+            if buffer.thread is None:
+                buffer.thread = threading.Thread(
+                    target=self._run,
+                    args=(buffer,),
+                    name="last-seen-flusher",
+                    daemon=True,
+                )
+                buffer.thread.start()
+
+    def _run(self, buffer):
+        while not buffer.stopped.is_set():
+            buffer.wakeup.wait(buffer.app.config["LAST_SEEN_FLUSH_INTERVAL"])
+            buffer.wakeup.clear()
+            self.flush(buffer.app)
+
+    def stop(self, app=None):
+        # stop the flusher thread and write what is still buffered
+        buffer = self._buffer(app)
+        buffer.stopped.set()
+        buffer.wakeup.set()
+        if buffer.thread is not None:
+            buffer.thread.join()
+            buffer.thread = None
+        self.flush(buffer.app)
+
+
+last_seen_buffer = LastSeenBuffer()
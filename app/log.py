@@ -0,0 +1,227 @@
+import atexit
+import logging
+import os
+import queue
+import smtplib
+import threading
+from email.message import EmailMessage
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# the app logger only puts the records on a queue, a listener thread writes them to the log file
+# and hands the errors to the mail handler, so a request never waits on the disk or on an smtp server
+# the errors are grouped by where they come from and mailed as one digest every LOG_MAIL_INTERVAL seconds
+# threads do not survive a fork, so every process (each worker forked from a preloaded master) starts its own
+# listener when it logs its first record
+
+
+class _DigestQueueHandler(QueueHandler):
+    # the record is formatted into a plain message before it crosses the queue,
+    # its origin is kept aside so the mail handler can group the repeats of the same error
+    def __init__(self, pipeline):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def enqueue(self, record):
+        self.pipeline.ensure_started()
+        self.pipeline.records.put_nowait(record)
+
+    def prepare(self, record):
+        if record.exc_info and record.exc_info[1] is not None:
+            error = record.exc_info[1]
+            traceback = error.__traceback__
+            while traceback is not None and traceback.tb_next is not None:
+                traceback = traceback.tb_next
+            frame = (
+                (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno)
+                if traceback is not None
+                else None
+            )
+            key = (record.levelname, type(error).__qualname__, frame)
+        else:
+            key = (record.levelname, record.pathname, record.lineno, str(record.msg))
+        record = super().prepare(record)
+        record.digest_key = key
+        return record
+
+
+class DigestMailHandler(logging.Handler):
+    def __init__(
+        self,
+        mailhost,
+        fromaddr,
+        toaddrs,
+        subject,
+        credentials=None,
+        secure=None,
+        interval=60,
+        timeout=5.0,
+        max_errors=50,
+    ):
+        super().__init__()
+        self.mailhost = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.secure = secure
+        self.interval = interval
+        self.timeout = timeout
+        # distinct errors listed in one digest, the others are only counted
+        self.max_errors = max_errors
+        self.reset()
+
+    def reset(self):
+        # a forked process starts without the errors, the timer and the lock of its parent
+        self._errors = {}
+        self._dropped = 0
+        self._timer = None
+        self._pending = threading.Lock()
+
+    def emit(self, record):
+        key = getattr(record, "digest_key", None) or (
+            record.levelname,
+            record.pathname,
+            record.lineno,
+            str(record.msg),
+        )
+        with self._pending:
+            if key in self._errors:
+                self._errors[key][0] += 1
+            elif len(self._errors) < self.max_errors:
+                self._errors[key] = [1, self.format(record)]
+            else:
+                self._dropped += 1
+            # the first error of a batch starts the clock, the ones arriving meanwhile join its digest
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._pending:
+            errors, dropped = list(self._errors.values()), self._dropped
+            self._errors, self._dropped = {}, 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if errors:
+            try:
+                self.send(errors, dropped)
+            except Exception:
+                self.handleError(None)
+
+    def send(self, errors, dropped):
+        total = sum(count for count, _ in errors) + dropped
+        message = EmailMessage()
+        message["From"] = self.fromaddr
+        message["To"] = ", ".join(self.toaddrs)
+        message["Subject"] = f"{self.subject} ({total} errors)"
+        sections = [f"{count} x {text}" for count, text in errors]
+        if dropped:
+            sections.append(f"{dropped} more errors of other kinds")
+        message.set_content("\n\n".join(sections))
+        host, port = self.mailhost
+        with smtplib.SMTP(host, port, timeout=self.timeout) as smtp:
+            if self.secure is not None:
+                smtp.ehlo()
+                smtp.starttls(*self.secure)
+                smtp.ehlo()
+            if self.credentials:
+                smtp.login(*self.credentials)
+            smtp.send_message(message)
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+class LogPipeline:
+    def __init__(self, app=None):
+        self.listener = None
+        self.handlers = []
+        self.records = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        handlers = []
+        if app.config["EMAIL_SERVER"]:
+            auth = None
+            if app.config["EMAIL_USERNAME"] or app.config["EMAIL_PASSWORD"]:
+                auth = (app.config["EMAIL_USERNAME"], app.config["EMAIL_PASSWORD"])
+            secure = None
+            if app.config["EMAIL_USE_TLS"]:
+                secure = ()
+            mail_handler = DigestMailHandler(
+                mailhost=(app.config["EMAIL_SERVER"], app.config["EMAIL_PORT"]),
+                fromaddr="no-reply@" + app.config["EMAIL_SERVER"],
+                toaddrs=app.config["ADMINS"],
+                subject="Microblog Failure",
+                credentials=auth,
+                secure=secure,
+                interval=app.config["LOG_MAIL_INTERVAL"],
+            )
+            # this means only logs with a level of ERROR or higher will be sent
+            mail_handler.setLevel(logging.ERROR)
+            handlers.append(mail_handler)
+
+        log_dir = app.config["LOG_DIR"]
+        os.makedirs(log_dir, exist_ok=True)
+        file_handler = RotatingFileHandler(
+            os.path.join(log_dir, "microblog.log"),
+            maxBytes=app.config["LOG_MAX_BYTES"],
+            backupCount=app.config["LOG_BACKUP_COUNT"],
+        )
+        file_handler.setFormatter(
+            logging.Formatter(
+                "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"
+            )
+        )
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+        self.start(app.logger, handlers)
+        app.logger.setLevel(logging.INFO)
+        atexit.register(self.stop)
+
+    def start(self, logger, handlers):
+        self.handlers = handlers
+        logger.addHandler(_DigestQueueHandler(self))
+
+    def ensure_started(self):
+        # the listener of this process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.records = queue.SimpleQueue()
+                self.listener = QueueListener(
+                    self.records, *self.handlers, respect_handler_level=True
+                )
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def _after_fork(self):
+        # the records still queued belong to the parent, which writes them
+        self._lock = threading.Lock()
+        self.listener = None
+        self.records = None
+        self._pid = None
+        for handler in self.handlers:
+            if isinstance(handler, DigestMailHandler):
+                handler.reset()
+
+    def stop(self):
+        # writes the queued records and sends the pending digest
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self._pid = None
+        for handler in self.handlers:
+            handler.close()
+
+
+log_pipeline = LogPipeline()
@@ -1,30 +1,81 @@
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy import delete, event, func, insert, inspect, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import object_session, validates
 from . import db, login
+from .cache import AdjacencyCache, ModelCache
+from .instrumentation import timed
+from .hashing import password_hasher
 from hashlib import md5
+from functools import lru_cache
 
 # association table for users : followers and followed
 
+# the composite primary key serves the (follower_id, followed_id) lookups of is_following and followed_posts
+# and the reverse index serves the lookups by followed user
+
 followers = db.Table(
     "followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_followers_followed_id_follower_id", "followed_id", "follower_id"),
+)
+
+# materialized home timelines : one row per (reader, post) pushed at write time
+# author_id is kept so that an unfollow can drop the rows of that author without a join
+
+timeline = db.Table(
+    "timeline",
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("author_id", db.Integer, db.ForeignKey("user.id"), index=True),
+    db.Column("time_stamp", db.DateTime),
+    db.Index("ix_timeline_user_id_time_stamp", "user_id", "time_stamp", "post_id"),
 )
 
 
+def hash_email(email):
+    return md5(email.lower().encode("utf-8")).hexdigest()
+
+
+# the same few (hash, size) pairs are formatted on every page, the urls are memoized
+@lru_cache(maxsize=4096)
+def avatar_url(email_hash, size):
+    return f"https://www.gravatar.com/avatar/{email_hash}?d=identicon&s={size}"
+
+
 # UserMixin has four methods necessary for the login manager : is_authenticated , is_active , is_anonymous , get_id
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # index =True is to make the search much faster at the expense of more memory
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    # md5 of the lowercased email used by the gravatar urls, set with the email so templates never hash it
+    email_hash = db.Column(db.String(32))
     hashed_password = db.Column(db.String(128))
     posts = db.relationship("Post", backref="author", lazy="dynamic")
 
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # denormalized counters so that displaying them does not need a COUNT over the followers and post tables
+    # they are kept up to date by follow, unfollow and post creation, "flask counters rebuild" repairs any drift
+    followers_count = db.Column(
+        db.Integer, default=0, server_default="0", nullable=False
+    )
+    followed_count = db.Column(
+        db.Integer, default=0, server_default="0", nullable=False
+    )
+    posts_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+
+    # bumped on every profile edit, cached renderings that show the user are keyed on it
+    profile_version = db.Column(
+        db.Integer, default=0, server_default="0", nullable=False
+    )
+
     # first argument is the the other side of the relationship and the second argument is the association table
 
     followed = db.relationship(
@@ -36,40 +87,112 @@ class User(UserMixin, db.Model):
         lazy="dynamic",
     )
 
+    # follow and unfollow check the followers table, the cached ids only serve the pages
+    # (another worker may have changed them since they were cached)
     def follow(self, user):
-        if not self.is_following(user):
+        if not self._follows(user):
             self.followed.append(user)
+            followed_cache.changed(db.session, self.id)
+            self._add_to_counter("followed_count", 1)
+            user._add_to_counter("followers_count", 1)
+            if current_app.config["TIMELINE_MATERIALIZED"]:
+                from .timeline import backfill
+
+                backfill(self, user)
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self._follows(user):
             self.followed.remove(user)
+            followed_cache.changed(db.session, self.id)
+            self._add_to_counter("followed_count", -1)
+            user._add_to_counter("followers_count", -1)
+            if current_app.config["TIMELINE_MATERIALIZED"]:
+                from .timeline import prune
+
+                prune(self, user)
+
+    # bulk versions of follow and unfollow for a list of usernames, resolved with one query
+    # they return the users that were found, unknown usernames and the user itself are ignored
+    def follow_many(self, usernames):
+        users = self._find_others(usernames)
+        follow_pairs([(self.id, user.id) for user in users])
+        return users
+
+    def unfollow_many(self, usernames):
+        users = self._find_others(usernames)
+        unfollow_pairs([(self.id, user.id) for user in users])
+        return users
+
+    def _find_others(self, usernames):
+        if not usernames:
+            return []
+        return User.query.filter(
+            User.username.in_(set(usernames)), User.id != self.id
+        ).all()
+
+    def _add_to_counter(self, counter, delta):
+        # a persisted row is updated with counter = counter + delta so concurrent requests do not lose updates
+        if inspect(self).persistent:
+            setattr(self, counter, getattr(User, counter) + delta)
+        else:
+            setattr(self, counter, (getattr(self, counter) or 0) + delta)
+
+    def profile_changed(self):
+        self._add_to_counter("profile_version", 1)
 
     def is_following(self, user):
+        # answered from the cached set of followed ids once the user is saved
+        if self.id is None or user.id is None:
+            return self._follows(user)
+        return followed_cache.contains(self.id, user.id)
+
+    def _follows(self, user):
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
 
     def followed_posts(self):
+        return self.followed_posts_page()[0]
+
+    def followed_posts_page(self):
+        # the followed posts with the columns to page them on (None for the post columns)
+        # read the precomputed timeline instead of running the union over the follow graph
+        if current_app.config["TIMELINE_MATERIALIZED"]:
+            from .timeline import timeline_page
+
+            return timeline_page(self)
         followed_posts = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)
         ).filter(followers.c.follower_id == self.id)
         own_posts = Post.query.filter_by(user_id=self.id)
-        return followed_posts.union(own_posts).order_by(Post.time_stamp.desc())
+        return followed_posts.union(own_posts).order_by(Post.time_stamp.desc()), None
 
     # def __repr__ for making debugging easier it give a clear representation of a database item when calling print on an db object
     def __repr__(self):
         return f"<User {self.username}>"
 
+    @validates("email")
+    def _set_email_hash(self, key, email):
+        self.email_hash = hash_email(email) if email is not None else None
+        return email
+
     # for setting up the gravatar image profile
     def avatar(self, size):
-        email_md5_hash = md5(self.email.lower().encode("utf-8")).hexdigest()
-        return f"https://www.gravatar.com/avatar/{email_md5_hash}?d=identicon&s={size}"
+        # rows written before the email_hash column was backfilled still get an avatar
+        return avatar_url(self.email_hash or hash_email(self.email), size)
 
     # methods for setting and checking the passwords of users
 
+    # the hashing itself runs in the password hasher process pool
+
     def set_password(self, password):
-        self.hashed_password = generate_password_hash(password)
+        with timed("hash"):
+            self.hashed_password = password_hasher.generate(password)
 
     def check_password(self, password):
-        return check_password_hash(self.hashed_password, password)
+        with timed("hash"):
+            return password_hasher.check(self.hashed_password, password)
+
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.hashed_password)
 
 
 class Post(db.Model):
@@ -79,12 +202,148 @@ class Post(db.Model):
     time_stamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
+    # the posts of a user ordered by time are read straight from this index
+    __table_args__ = (db.Index("ix_post_user_id_time_stamp", "user_id", "time_stamp"),)
+
     def __repr__(self):
         return f"<Post {self.body}>"
 
 
+# the posts counter is updated in the same transaction as the insert or delete of the post
+
+
+@event.listens_for(Post, "after_insert")
+def count_new_post(mapper, connection, post):
+    connection.execute(
+        update(User)
+        .where(User.id == post.user_id)
+        .values(posts_count=User.posts_count + 1)
+    )
+    user_cache.changed(object_session(post), post.user_id)
+
+
+@event.listens_for(Post, "after_delete")
+def count_deleted_post(mapper, connection, post):
+    connection.execute(
+        update(User)
+        .where(User.id == post.user_id)
+        .values(posts_count=User.posts_count - 1)
+    )
+    user_cache.changed(object_session(post), post.user_id)
+
+
+def _followers_count():
+    return (
+        select(func.count())
+        .select_from(followers)
+        .where(followers.c.followed_id == User.id)
+        .scalar_subquery()
+    )
+
+
+def _followed_count():
+    return (
+        select(func.count())
+        .select_from(followers)
+        .where(followers.c.follower_id == User.id)
+        .scalar_subquery()
+    )
+
+
+def rebuild_counters():
+    # recompute every counter from the followers and post tables with one set based UPDATE
+    db.session.execute(
+        update(User).values(
+            followers_count=_followers_count(),
+            followed_count=_followed_count(),
+            posts_count=select(func.count())
+            .select_from(Post)
+            .where(Post.user_id == User.id)
+            .scalar_subquery(),
+        )
+    )
+    db.session.commit()
+
+
+def _insert_follows(pairs):
+    # one multi row INSERT that skips the pairs already followed instead of failing on the primary key
+    rows = [{"follower_id": a, "followed_id": b} for a, b in pairs]
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "sqlite":
+        statement = sqlite_insert(followers).on_conflict_do_nothing()
+    elif dialect == "postgresql":
+        statement = postgresql_insert(followers).on_conflict_do_nothing()
+    elif dialect in ("mysql", "mariadb"):
+        statement = insert(followers).prefix_with("IGNORE")
+    else:
+        existing = set(
+            db.session.execute(
+                select(followers.c.follower_id, followers.c.followed_id).where(
+                    tuple_(followers.c.follower_id, followers.c.followed_id).in_(pairs)
+                )
+            ).all()
+        )
+        rows = [row for row, pair in zip(rows, pairs) if pair not in existing]
+        statement = insert(followers)
+    if rows:
+        db.session.execute(statement, rows)
+
+
+def refresh_follow_counters(ids):
+    # recount the followers and followed of the given users after a bulk change of the follow graph
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(ids))
+        .values(followers_count=_followers_count(), followed_count=_followed_count()),
+        execution_options={"synchronize_session": "fetch"},
+    )
+    for id in ids:
+        user_cache.changed(db.session, id)
+
+
+def follow_pairs(pairs):
+    # adds the (follower id, followed id) pairs with set based statements, the caller commits
+    pairs = sorted({(a, b) for a, b in pairs if a != b})
+    if not pairs:
+        return
+    for follower_id, _ in pairs:
+        followed_cache.changed(db.session, follower_id)
+    _insert_follows(pairs)
+    refresh_follow_counters({id for pair in pairs for id in pair})
+    if current_app.config["TIMELINE_MATERIALIZED"]:
+        from .timeline import backfill_pairs
+
+        backfill_pairs(pairs)
+
+
+def unfollow_pairs(pairs):
+    pairs = sorted({(a, b) for a, b in pairs if a != b})
+    if not pairs:
+        return
+    for follower_id, _ in pairs:
+        followed_cache.changed(db.session, follower_id)
+    db.session.execute(
+        delete(followers).where(
+            tuple_(followers.c.follower_id, followers.c.followed_id).in_(pairs)
+        )
+    )
+    refresh_follow_counters({id for pair in pairs for id in pair})
+    if current_app.config["TIMELINE_MATERIALIZED"]:
+        from .timeline import prune_pairs
+
+        prune_pairs(pairs)
+
+
+# users restored from the session cookie are served from the user cache, only a miss goes to the database
+user_cache = ModelCache(User, "user")
+# ids followed by each user, for is_following
+followed_cache = AdjacencyCache(
+    followers.c.follower_id, followers.c.followed_id, "followed"
+)
+
+
 # the call back function that decorates the user_loader must interact with the User model and checks if the id given as a string exists in the database
 # if not it should return None
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.get(int(id))
@@ -0,0 +1,133 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from flask import current_app, request, url_for
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import selectinload
+from .models import Post
+
+# keyset (cursor) pagination over (Post.time_stamp, Post.id), or over the columns of another table holding
+# the same values in an index (the materialized timeline), so that the rows are read in the order of that index
+# the next page is fetched with before=<cursor of the last post>, the previous one with after=<cursor of the first post>
+# this avoids both the OFFSET scan and the COUNT(*) that paginate() runs on every request
+
+
+def encode_key(values):
+    # opaque url safe token of a list of json values
+    token = base64.urlsafe_b64encode(json.dumps(values).encode("utf-8"))
+    return token.decode("ascii").rstrip("=")
+
+
+def decode_key(token):
+    # raises ValueError for a token that was not made by encode_key
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (binascii.Error, ValueError, TypeError, UnicodeError):
+        raise ValueError(token)
+    if not isinstance(values, list):
+        raise ValueError(token)
+    return values
+
+
+def encode_cursor(post):
+    return encode_key([post.time_stamp.isoformat(), post.id])
+
+
+def decode_cursor(token):
+    # returns None for a missing or tampered cursor so that the first page is shown instead
+    if not token:
+        return None
+    try:
+        time_stamp, id = decode_key(token)
+        return datetime.fromisoformat(time_stamp), int(id)
+    except (ValueError, TypeError):
+        return None
+
+
+class KeysetPage:
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1]) if self.has_next and self.items else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0]) if self.has_prev and self.items else None
+
+
+def keyset_paginate(query, per_page, before=None, after=None, key=None):
+    time_stamp_column, id_column = key or (Post.time_stamp, Post.id)
+    query = query.order_by(None)
+    if after is not None:
+        time_stamp, id = after
+        rows = (
+            query.filter(
+                or_(
+                    time_stamp_column > time_stamp,
+                    and_(time_stamp_column == time_stamp, id_column > id),
+                )
+            )
+            .order_by(time_stamp_column.asc(), id_column.asc())
+            .limit(per_page + 1)
+            .all()
+        )
+        has_prev = len(rows) > per_page
+        return KeysetPage(list(reversed(rows[:per_page])), True, has_prev)
+
+    if before is not None:
+        time_stamp, id = before
+        query = query.filter(
+            or_(
+                time_stamp_column < time_stamp,
+                and_(time_stamp_column == time_stamp, id_column < id),
+            )
+        )
+    rows = (
+        query.order_by(time_stamp_column.desc(), id_column.desc())
+        .limit(per_page + 1)
+        .all()
+    )
+    return KeysetPage(rows[:per_page], len(rows) > per_page, before is not None)
+
+
+def paginate_posts(query, endpoint, key=None, **values):
+    # returns the posts of the current page with the urls of the older and newer pages
+    # the legacy ?page= urls keep using OFFSET pagination
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    # _post.html renders the author of every post, load them all in one extra query instead of one per post
+    query = query.options(selectinload(Post.author))
+    page = request.args.get("page", type=int)
+    if page is not None:
+        posts = query.paginate(page=page, per_page=per_page, error_out=False)
+        next_url = (
+            url_for(endpoint, page=posts.next_num, **values) if posts.has_next else None
+        )
+        prev_url = (
+            url_for(endpoint, page=posts.prev_num, **values) if posts.has_prev else None
+        )
+        return posts.items, next_url, prev_url
+
+    posts = keyset_paginate(
+        query,
+        per_page,
+        before=decode_cursor(request.args.get("before")),
+        after=decode_cursor(request.args.get("after")),
+        key=key,
+    )
+    next_url = (
+        url_for(endpoint, before=posts.next_cursor, **values)
+        if posts.next_cursor
+        else None
+    )
+    prev_url = (
+        url_for(endpoint, after=posts.prev_cursor, **values)
+        if posts.prev_cursor
+        else None
+    )
+    return posts.items, next_url, prev_url
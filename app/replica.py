@@ -0,0 +1,69 @@
+import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, TextClause
+
+# read/write splitting with a read only replica configured as the "replica" bind (REPLICA_DATABASE_URL)
+# the reads of GET and HEAD requests go to the replica, everything else and every write go to the primary
+# the replica may be up to REPLICA_MAX_LAG seconds behind the primary, so after a request writes,
+# the requests of the same browser stay on the primary for that long and read their own writes
+# requests of a browser that wrote are remembered in its session cookie
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and g.get("_db_replica"):
+            if not self._flushing and _is_read(clause):
+                return self._db.engines["replica"]
+            # a write, the rest of the request reads from the primary
+            g._db_replica = False
+            g._db_wrote = True
+        elif has_request_context() and (self._flushing or not _is_read(clause)):
+            g._db_wrote = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _is_read(clause):
+    if isinstance(clause, Select):
+        return True
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip().upper().startswith("SELECT")
+    return False
+
+
+class ReplicaRouter:
+    def __init__(self, app=None, db=None):
+        self.db = db
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.db = db
+        # before the other before_request functions, which may already query
+        app.before_request_funcs.setdefault(None, []).insert(0, self._route_request)
+        app.after_request(self._remember_write)
+
+    @property
+    def enabled(self):
+        return "replica" in self.db.engines
+
+    def _route_request(self):
+        g._db_replica = (
+            self.enabled
+            and request.method in ("GET", "HEAD")
+            and session.get("_primary_until", 0) < time.time()
+        )
+
+    def _remember_write(self, response):
+        if self.enabled and g.get("_db_wrote"):
+            session["_primary_until"] = (
+                time.time() + current_app.config["REPLICA_MAX_LAG"]
+            )
+        return response
+
+    def primary(self):
+        # bind arguments that pin a query to the primary, e.g. db.session.get(..., bind_arguments=router.primary())
+        return {"bind": self.db.engine}
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import parse_qs
+from flask import current_app, request, session
+from flask_login import current_user
+
+# whole page cache for the anonymous GET requests, keyed on the endpoint and the query string
+# an entry is fresh for RESPONSE_CACHE_TTL seconds, then it is still served for RESPONSE_CACHE_STALE seconds
+# while a background thread renders it again (stale-while-revalidate)
+# only one request renders a missing page, the others arriving meanwhile wait for its result
+
+
+class _Entry:
+    def __init__(self, response):
+        self.body = response.get_data()
+        self.status = response.status_code
+        self.headers = [
+            (name, value)
+            for name, value in response.headers.items()
+            if name.lower() != "set-cookie"
+        ]
+        self.created = time.monotonic()
+
+    def response(self, state):
+        response = current_app.response_class(self.body, self.status, self.headers)
+        response.headers["X-Cache"] = state
+        # the cached page carries the etag of the view so revalidations still get a 304
+        return response.make_conditional(request)
+
+
+class ResponseCache:
+    def __init__(self, app=None):
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["response_cache"] = self
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self._cacheable():
+                return view(*args, **kwargs)
+            key = (request.endpoint, request.query_string)
+            ttl = current_app.config["RESPONSE_CACHE_TTL"]
+            stale = current_app.config["RESPONSE_CACHE_STALE"]
+            while True:
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        self._entries.move_to_end(key)
+                    age = time.monotonic() - entry.created if entry else None
+                    if entry is not None and age < ttl:
+                        return entry.response("HIT")
+                    waiting = self._inflight.get(key)
+                    if waiting is None:
+                        refresh = threading.Event()
+                        self._inflight[key] = refresh
+                if entry is not None and age < ttl + stale:
+                    if waiting is None:
+                        self._refresh_in_background(key, view, kwargs, refresh)
+                    return entry.response("STALE")
+                if waiting is None:
+                    break
+                # another request is rendering this page, use its result
+                if not waiting.wait(current_app.config["RESPONSE_CACHE_WAIT"]):
+                    return view(*args, **kwargs)
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+                self._store(key, response)
+            finally:
+                self._done(key, refresh)
+            response.headers["X-Cache"] = "MISS"
+            return response
+
+        return wrapper
+
+    def invalidate(self, endpoint):
+        # drops the pages of endpoint that show the newest posts,
+        # the pages read with a before= cursor only hold older posts and stay valid
+        with self._lock:
+            for key in list(self._entries):
+                name, query_string = key
+                if name == endpoint and "before" not in parse_qs(query_string.decode()):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _cacheable(self):
+        # flashed messages are part of the page, a request showing them is never cached
+        return (
+            current_app.config["RESPONSE_CACHE_TTL"] > 0
+            and request.method == "GET"
+            and current_user.is_anonymous
+            and "_flashes" not in session
+        )
+
+    def _store(self, key, response):
+        if response.status_code != 200 or response.direct_passthrough:
+            return
+        entry = _Entry(response)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > current_app.config["RESPONSE_CACHE_SIZE"]:
+                self._entries.popitem(last=False)
+
+    def _done(self, key, refresh):
+        with self._lock:
+            self._inflight.pop(key, None)
+        refresh.set()
+
+    def _refresh_in_background(self, key, view, kwargs, refresh):
+        # the refresh thread renders the page with the app of the request
+        app = current_app._get_current_object()
+        path, query_string = request.path, request.query_string
+
+        def run():
+            try:
+                with app.test_request_context(path, query_string=query_string):
+                    self._store(key, app.make_response(view(**kwargs)))
+            except Exception:
+                app.logger.exception("Could not refresh the cached page %s", path)
+            finally:
+                self._done(key, refresh)
+
+        threading.Thread(target=run, name="response-cache-refresh", daemon=True).start()
+
+
+response_cache = ResponseCache()
@@ -1,14 +1,25 @@
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request
+from flask import render_template, flash, redirect, url_for, request, jsonify, abort
+from flask import Blueprint, Response, current_app, stream_with_context
 from werkzeug.urls import url_parse
 from flask_login import login_user, logout_user, current_user, login_required
 from .models import User, Post
-from . import app, db
+from . import db
 from .forms import LoginForm, RegisterForm, EditPersonalInfoForm, EmptyForm, PostForm
+from .forms import SearchForm
+from .pagination import paginate_posts
+from .last_seen import last_seen_buffer
+from .throttle import login_throttle
+from .conditional import conditional_page, csrf_period, newest_post, page_authors
+from .conditional import page_etag
+from .response_cache import response_cache
+from .export import MIMETYPES, ExportError, export, parse_since
+from .search import search as post_search
 
+bp = Blueprint("main", __name__)
 
-@app.route("/", methods=["POST", "GET"])
-@app.route("/index", methods=["POST", "GET"])
+
+@bp.route("/", methods=["POST", "GET"])
+@bp.route("/index", methods=["POST", "GET"])
 @login_required
 def index():
     form = PostForm()
@@ -17,25 +28,21 @@ def index():
         post = Post(body=form.body.data, author=current_user)
         db.session.add(post)
         db.session.commit()
+        # the cached anonymous explore pages showing the newest posts are out of date now
+        response_cache.invalidate("main.explore")
         flash("Post added successfully")
 
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     title = "Home"
     user = current_user
-    page = request.args.get("page", 1, int)
-
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=app.config["POSTS_PER_PAGE"], error_out=False
-    )
-
-    next_url = url_for("index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("index", page=posts.prev_num) if posts.has_prev else None
+    query, key = current_user.followed_posts_page()
+    posts, next_url, prev_url = paginate_posts(query, "main.index", key=key)
 
     return render_template(
         "index.html",
         title=title,
-        posts=posts.items,
+        posts=posts,
         user=user,
         form=form,
         next_url=next_url,
@@ -46,41 +53,58 @@ def index():
 # route to display all the posts by all users
 
 
-@app.route("/explore")
+@bp.route("/explore")
+@response_cache.cached
 def explore():
-    page = request.args.get("page", 1, int)
-    posts = Post.query.order_by(Post.time_stamp.desc()).paginate(
-        page=page, per_page=app.config["POSTS_PER_PAGE"], error_out=False
+    # the page changes with its posts and the profiles of their authors, they are read once for the etag and
+    # the rendering, a client that has the page already gets a 304 without the template being rendered
+    # there is no Last-Modified, a renamed author leaves the time stamps of the posts as they were
+    posts, next_url, prev_url = paginate_posts(
+        Post.query.order_by(Post.time_stamp.desc()), "main.explore"
     )
+    etag = page_etag(page_authors(posts), next_url, prev_url)
 
-    next_url = url_for("explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("explore", page=posts.prev_num) if posts.has_prev else None
+    def render():
+        return render_template(
+            "index.html",
+            posts=posts,
+            user=current_user,
+            next_url=next_url,
+            prev_url=prev_url,
+        )
 
-    return render_template(
-        "index.html",
-        posts=posts.items,
-        user=current_user,
-        next_url=next_url,
-        prev_url=prev_url,
-    )
+    return conditional_page(etag, None, render, public=current_user.is_anonymous)
 
 
 # authentication routes
-@app.route("/login", methods=["POST", "GET"])
+@bp.route("/login", methods=["POST", "GET"])
 def login():
     title = "Login"
     form = LoginForm()
     # if the user is already authenticated redirect him to the home page
     if current_user.is_authenticated:
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
     # if the form is valid
     if form.validate_on_submit():
+        # refuse the attempt before hashing anything when this address or this username has failed too often
+        username_key = f"username:{form.username.data}"
+        if throttled(f"ip:{request.remote_addr}", "LOGIN_ATTEMPTS_PER_IP") or (
+            throttled(username_key, "LOGIN_ATTEMPTS_PER_USERNAME", hit=False)
+        ):
+            flash("Too many login attempts, please try again later")
+            return render_template("login.html", form=form, title=title), 429
         # query the database for the user by the user_name
         user = User.query.filter_by(username=form.username.data).first()
         # if the user does not exist or password is incorrect flash error message and redirect to login
         if user is None or not user.check_password(form.password.data):
+            login_throttle.hit(username_key, current_app.config["LOGIN_ATTEMPT_WINDOW"])
             flash("User is invalid or credentials are not correct")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
+        login_throttle.reset(username_key)
+        # hashes made with older parameters are replaced now that we know the password
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
         # if the user is correct and credentials are correct login the user and remember him
         login_user(user, remember=form.remember_me.data)
         # redirect to home page by default if there was no previous page before the redirect
@@ -88,81 +112,103 @@ def login():
         if (
             not next_page or url_parse(next_page).netloc != ""
         ):  # we check if a malicious user has set next query to a absolute url for another website, we do that by checking if the network locator of the url passed is relative , that's only the case when netloc is equal to ''
-            next_page = url_for("index")
+            next_page = url_for("main.index")
         return redirect(next_page)
     return render_template("login.html", form=form, title=title)
 
 
-@app.route("/logout")
+def throttled(key, limit_setting, hit=True):
+    # checks the attempts of key against its limit and records this attempt
+    window = current_app.config["LOGIN_ATTEMPT_WINDOW"]
+    if login_throttle.blocked(key, current_app.config[limit_setting], window):
+        return True
+    if hit:
+        login_throttle.hit(key, window)
+    return False
+
+
+@bp.route("/logout")
 def logout():
     logout_user()
-    return redirect(url_for("index"))
+    return redirect(url_for("main.index"))
 
 
-@app.route("/register", methods=["POST", "GET"])
+@bp.route("/register", methods=["POST", "GET"])
 def register():
     title = "register"
     if current_user.is_authenticated:  # type: ignore
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     form = RegisterForm()
     if form.validate_on_submit():
+        if throttled(f"ip:{request.remote_addr}", "LOGIN_ATTEMPTS_PER_IP"):
+            flash("Too many attempts, please try again later")
+            return render_template("register.html", form=form, title=title), 429
         user = User(username=form.username.data, email=form.email.data)  # type: ignore
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
         login_user(user, remember=True)
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     return render_template("register.html", form=form, title=title)
 
 
-@app.route("/user/<username>")
+@bp.route("/user/<username>")
 @login_required
 def user_profile(username):
     # this empty form is for the follow unfollow functionality
     form = EmptyForm()
-    page = request.args.get("page", 1, int)
     user = User.query.filter_by(username=username).first_or_404()
     title = f"Profile : {user.username}"
-    posts = user.posts.order_by(Post.time_stamp.desc()).paginate(
-        page=page, per_page=app.config["POSTS_PER_PAGE"], error_out=False
-    )
-
-    # urls for pagination of the posts
-    next_url = (
-        url_for("user_profile", username=user.username, page=posts.next_num)
-        if posts.has_next
-        else None
-    )
-    prev_url = (
-        url_for("user_profile", username=user.username, page=posts.prev_num)
-        if posts.has_prev
-        else None
+    last_seen = last_seen_buffer.last_seen(user)
+    # everything the page shows about the user is in the etag, the follow form adds its csrf token period
+    newest = newest_post(user.posts)
+    etag = page_etag(
+        tuple(newest or ()),
+        user.id,
+        user.profile_version,
+        user.followers_count,
+        user.followed_count,
+        last_seen,
+        csrf_period(),
     )
 
-    return render_template(
-        "profile.html",
-        posts=posts.items,
-        title=title,
-        user=user,
-        form=form,
-        next_url=next_url,
-        prev_url=prev_url,
-    )
+    def render():
+        # posts of the page and urls for pagination of the posts
+        posts, next_url, prev_url = paginate_posts(
+            user.posts.order_by(Post.time_stamp.desc()),
+            "main.user_profile",
+            username=user.username,
+        )
+        return render_template(
+            "profile.html",
+            posts=posts,
+            title=title,
+            user=user,
+            last_seen=last_seen,
+            form=form,
+            next_url=next_url,
+            prev_url=prev_url,
+        )
+
+    return conditional_page(etag, newest.time_stamp if newest else None, render)
 
 
 # define a route that handles that editing the persons profile info
-@app.route("/edit_profile", methods=["POST", "GET"])
+@bp.route("/edit_profile", methods=["POST", "GET"])
 def edit_profile():
     form = EditPersonalInfoForm(current_user.username)
     title = "Edit profile"
     if form.validate_on_submit():
         current_user.about_me = form.about_me.data
         current_user.username = form.username.data
+        current_user.profile_changed()
         db.session.commit()
+        # the cached anonymous explore pages may show the old username
+        response_cache.invalidate("main.explore")
         flash("Your changes have been saved")
-        return redirect(url_for("user_profile", username=current_user.username))
+        return redirect(url_for("main.user_profile", username=current_user.username))
     elif request.method == "GET":
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
@@ -170,7 +216,7 @@ def edit_profile():
     return render_template("edit_profile.html", form=form, title=title)
 
 
-@app.route("/follow/<username>", methods=["POST", "GET"])
+@bp.route("/follow/<username>", methods=["POST", "GET"])
 @login_required
 def follow(username):
     form = EmptyForm()
@@ -178,20 +224,20 @@ def follow(username):
         followed_user = User.query.filter_by(username=username).first()
         if followed_user is None:
             flash("This user does not exist")
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
         if followed_user == current_user:
             flash("you can not follow yourself")
-            return redirect(url_for("user", username=username))
+            return redirect(url_for("main.user_profile", username=username))
         current_user.follow(followed_user)
         db.session.commit()
         flash(f"You are following {username}")
-        return redirect(url_for("user_profile", username=username))
+        return redirect(url_for("main.user_profile", username=username))
 
     else:
-        redirect(url_for("index"))
+        redirect(url_for("main.index"))
 
 
-@app.route("/unfollow/<username>", methods=["POST", "GET"])
+@bp.route("/unfollow/<username>", methods=["POST", "GET"])
 @login_required
 def unfollow(username):
     form = EmptyForm()
@@ -199,22 +245,92 @@ def unfollow(username):
         followed_user = User.query.filter_by(username=username).first()
         if followed_user is None:
             flash("This user does not exist")
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
         if followed_user == current_user:
             flash("you can not unfollow yourself")
-            return redirect(url_for("user", username=username))
+            return redirect(url_for("main.user_profile", username=username))
         current_user.unfollow(followed_user)
         db.session.commit()
         flash(f"You are now not following {username}")
-        return redirect(url_for("user_profile", username=username))
+        return redirect(url_for("main.user_profile", username=username))
 
     else:
-        redirect(url_for("index"))
+        redirect(url_for("main.index"))
+
+
+# bulk follow (POST) and unfollow (DELETE) of a json list of usernames : {"usernames": ["susan", ...]}
+# only json bodies are accepted, a cross site form can not send one without a cors preflight
+@bp.route("/follows", methods=["POST", "DELETE"])
+@login_required
+def bulk_follow():
+    data = request.get_json(silent=True)
+    usernames = data.get("usernames") if isinstance(data, dict) else None
+    if not isinstance(usernames, list) or not all(
+        isinstance(username, str) for username in usernames
+    ):
+        return jsonify(error="expected a json object with a list of usernames"), 400
+    if len(usernames) > current_app.config["FOLLOW_BATCH_MAX"]:
+        return (
+            jsonify(
+                error=f"at most {current_app.config['FOLLOW_BATCH_MAX']} usernames per request"
+            ),
+            413,
+        )
+    if request.method == "POST":
+        users = current_user.follow_many(usernames)
+    else:
+        users = current_user.unfollow_many(usernames)
+    db.session.commit()
+    found = {user.username for user in users}
+    return jsonify(
+        usernames=sorted(found),
+        unknown=sorted(set(usernames) - found - {current_user.username}),
+        followed_count=current_user.followed_count,
+    )
+
+
+# full text search of the posts, ranked by the search backend and paginated with ?cursor=
+@bp.route("/search")
+@login_required
+def search():
+    form = SearchForm()
+    posts, next_url = [], None
+    if form.validate():
+        posts, next_cursor = post_search.search(form.q.data, request.args.get("cursor"))
+        if next_cursor:
+            next_url = url_for("main.search", q=form.q.data, cursor=next_cursor)
+    return render_template(
+        "search.html", title="Search", form=form, posts=posts, next_url=next_url
+    )
+
+
+# streamed export of the posts or users for the admins, resumed with ?after=<cursor> and incremental with ?since=<time stamp>
+@bp.route("/export/<kind>")
+@login_required
+def export_data(kind):
+    if current_user.email not in current_app.config["ADMINS"]:
+        abort(403)
+    format = request.args.get("format", "jsonl")
+    try:
+        chunks = export(
+            kind,
+            format,
+            after=request.args.get("after"),
+            since=parse_since(request.args.get("since")),
+            batch_size=current_app.config["EXPORT_BATCH_SIZE"],
+        )
+    except ExportError as error:
+        return jsonify(error=str(error)), 400
+    return Response(
+        stream_with_context(chunks),
+        mimetype=MIMETYPES[format],
+        headers={"Content-Disposition": f"attachment; filename={kind}.{format}"},
+    )
 
 
 # defining when the user is last seen
-@app.before_request
+# the time is only buffered here, it is written to the database in bulk by the last seen flusher
+@bp.before_app_request
 def set_last_seen():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen_buffer.touch(current_user.id)
@@ -0,0 +1,173 @@
+import re
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import selectinload
+from . import db
+from .models import Post
+from .pagination import decode_cursor, decode_key, encode_key, keyset_paginate
+
+# full text search over the post bodies behind a pluggable backend chosen with SEARCH_BACKEND
+# "fts5" keeps an SQLite FTS5 index of the bodies, updated on every post insert and delete, and ranks the matches with bm25
+# "like" is the fallback for the other databases, it scans the post table and orders the matches by date
+# a backend returns one page of posts and the cursor of the next page
+
+
+def search_terms(query):
+    return re.findall(r"\w+", query or "")
+
+
+class SearchBackend:
+    # the index hooks run on the connection of the flush or of the DDL
+    def create(self, connection):
+        pass
+
+    def drop(self, connection):
+        pass
+
+    def index(self, connection, post):
+        pass
+
+    def remove(self, connection, post):
+        pass
+
+    def rebuild(self, connection):
+        pass
+
+    def search(self, terms, per_page, cursor=None):
+        raise NotImplementedError
+
+
+class LikeBackend(SearchBackend):
+    def search(self, terms, per_page, cursor=None):
+        query = Post.query.options(selectinload(Post.author))
+        for term in terms:
+            query = query.filter(Post.body.icontains(term, autoescape=True))
+        page = keyset_paginate(query, per_page, before=decode_cursor(cursor))
+        return page.items, page.next_cursor
+
+
+class Fts5Backend(SearchBackend):
+    # external content table : the index stores no copy of the bodies, they are read from the post table
+    def create(self, connection):
+        connection.execute(
+            text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts "
+                "USING fts5(body, content='post', content_rowid='id')"
+            )
+        )
+
+    def drop(self, connection):
+        connection.execute(text("DROP TABLE IF EXISTS post_fts"))
+
+    def index(self, connection, post):
+        connection.execute(
+            text("INSERT INTO post_fts (rowid, body) VALUES (:id, :body)"),
+            {"id": post.id, "body": post.body},
+        )
+
+    def remove(self, connection, post):
+        # an external content index is told the removed text so it can drop its tokens
+        connection.execute(
+            text(
+                "INSERT INTO post_fts (post_fts, rowid, body) "
+                "VALUES ('delete', :id, :body)"
+            ),
+            {"id": post.id, "body": post.body},
+        )
+
+    def rebuild(self, connection):
+        connection.execute(text("INSERT INTO post_fts (post_fts) VALUES ('rebuild')"))
+
+    def _decode(self, cursor):
+        # None for a missing or tampered cursor so that the first page is shown instead
+        if not cursor:
+            return None
+        try:
+            rank, id = decode_key(cursor)
+            return float(rank), int(id)
+        except (ValueError, TypeError):
+            return None
+
+    def search(self, terms, per_page, cursor=None):
+        # every term is quoted so the fts5 query syntax can not be injected, the terms are ANDed
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        sql = "SELECT rowid, rank FROM post_fts WHERE post_fts MATCH :match"
+        params = {"match": match, "limit": per_page + 1}
+        # keyset over (rank, rowid), a better match has a lower bm25 score
+        after = self._decode(cursor)
+        if after is not None:
+            sql += " AND (rank > :rank OR (rank = :rank AND rowid > :id))"
+            params.update(rank=after[0], id=after[1])
+        sql += " ORDER BY rank, rowid LIMIT :limit"
+        rows = db.session.execute(text(sql), params).all()
+        ids = [row.rowid for row in rows[:per_page]]
+        posts = {
+            post.id: post
+            for post in Post.query.options(selectinload(Post.author)).filter(
+                Post.id.in_(ids)
+            )
+        }
+        next_cursor = None
+        if len(rows) > per_page:
+            last = rows[per_page - 1]
+            next_cursor = encode_key([last.rank, last.rowid])
+        return [posts[id] for id in ids if id in posts], next_cursor
+
+
+BACKENDS = {"fts5": Fts5Backend, "like": LikeBackend}
+
+
+class Search:
+    def __init__(self, app=None):
+        self._default = LikeBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config["SEARCH_BACKEND"]
+        if name is None:
+            # fts5 is compiled in the sqlite shipped with python, other databases get the fallback
+            url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+            name = "fts5" if url.get_backend_name() == "sqlite" else "like"
+        app.extensions["search"] = BACKENDS[name]()
+
+    # the backend of the current app, the like search outside of an app
+    @property
+    def backend(self):
+        if has_app_context():
+            return current_app.extensions.get("search", self._default)
+        return self._default
+
+    @backend.setter
+    def backend(self, backend):
+        current_app.extensions["search"] = backend
+
+    def search(self, query, cursor=None):
+        terms = search_terms(query)
+        if not terms:
+            return [], None
+        return self.backend.search(terms, current_app.config["POSTS_PER_PAGE"], cursor)
+
+
+search = Search()
+
+
+@event.listens_for(Post.__table__, "after_create")
+def create_search_index(table, connection, **kw):
+    search.backend.create(connection)
+
+
+@event.listens_for(Post.__table__, "before_drop")
+def drop_search_index(table, connection, **kw):
+    search.backend.drop(connection)
+
+
+@event.listens_for(Post, "after_insert")
+def index_new_post(mapper, connection, post):
+    search.backend.index(connection, post)
+
+
+@event.listens_for(Post, "after_delete")
+def remove_deleted_post(mapper, connection, post):
+    search.backend.remove(connection, post)
@@ -0,0 +1,290 @@
+import atexit
+import heapq
+import itertools
+import json
+import sqlite3
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event
+from . import db
+
+# background jobs for the side effects of a request that do not have to be done before its response
+# a job is enqueued once the transaction that asks for it commits, so a worker always sees the committed rows
+# TASK_QUEUE chooses where the jobs wait :
+#   "inline"  the job runs right after the commit in the process that enqueued it (tests, development)
+#   "memory"  a heap in the web process, consumed by TASK_WORKERS threads, lost on restart
+#   "sqlite"  a table in the TASK_QUEUE_PATH sqlite file, survives restarts and can be consumed by "flask worker"
+# a failed job is retried TASK_MAX_ATTEMPTS times with an exponential backoff starting at TASK_RETRY_DELAY seconds
+
+
+class Job:
+    def __init__(self, id, name, payload, attempts=0):
+        self.id = id
+        self.name = name
+        self.payload = payload
+        self.attempts = attempts
+
+
+class MemoryBackend:
+    def __init__(self):
+        self._jobs = []
+        self._ids = itertools.count(1)
+        self._ready = threading.Condition()
+
+    def put(self, name, payload, run_at=0.0, attempts=0):
+        with self._ready:
+            job = Job(next(self._ids), name, payload, attempts)
+            heapq.heappush(self._jobs, (run_at, job.id, job))
+            self._ready.notify()
+
+    def claim(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._ready:
+            while True:
+                now = time.monotonic()
+                if self._jobs and self._jobs[0][0] <= time.time():
+                    return heapq.heappop(self._jobs)[2]
+                if now >= deadline:
+                    return None
+                wait = deadline - now
+                if self._jobs:
+                    wait = min(wait, max(self._jobs[0][0] - time.time(), 0.0))
+                self._ready.wait(wait)
+
+    def ack(self, job):
+        pass
+
+    def retry(self, job, run_at, error):
+        self.put(job.name, job.payload, run_at, job.attempts + 1)
+
+    def fail(self, job, error):
+        pass
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class SqliteBackend:
+    # a claimed job is hidden from the other workers for TASK_LEASE seconds,
+    # a worker that dies while running it lets it run again once the lease is over
+    def __init__(self, path, lease):
+        self.path = path
+        self.lease = lease
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS job ("
+                "id INTEGER PRIMARY KEY, name TEXT NOT NULL, payload TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, run_at REAL NOT NULL, "
+                "claimed_until REAL, failed INTEGER NOT NULL DEFAULT 0, error TEXT)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_job_run_at ON job (failed, run_at)"
+            )
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            self._local.connection = connection
+        return connection
+
+    def put(self, name, payload, run_at=0.0, attempts=0):
+        self._connect().execute(
+            "INSERT INTO job (name, payload, attempts, run_at) VALUES (?, ?, ?, ?)",
+            (name, json.dumps(payload), attempts, run_at),
+        )
+
+    def _claim_one(self):
+        connection = self._connect()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock first so two workers never claim the same job
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, name, payload, attempts FROM job "
+                "WHERE failed = 0 AND run_at <= ? "
+                "AND (claimed_until IS NULL OR claimed_until < ?) "
+                "ORDER BY run_at, id LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE job SET claimed_until = ? WHERE id = ?",
+                    (now + self.lease, row[0]),
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return Job(row[0], row[1], json.loads(row[2]), row[3])
+
+    def claim(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim_one()
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(0.2, max(deadline - time.monotonic(), 0.0)))
+
+    def ack(self, job):
+        self._connect().execute("DELETE FROM job WHERE id = ?", (job.id,))
+
+    def retry(self, job, run_at, error):
+        self._connect().execute(
+            "UPDATE job SET attempts = attempts + 1, run_at = ?, claimed_until = NULL, "
+            "error = ? WHERE id = ?",
+            (run_at, error, job.id),
+        )
+
+    def fail(self, job, error):
+        # failed jobs are kept for inspection
+        self._connect().execute(
+            "UPDATE job SET attempts = attempts + 1, failed = 1, error = ? WHERE id = ?",
+            (error, job.id),
+        )
+
+    def __len__(self):
+        return (
+            self._connect()
+            .execute("SELECT count(*) FROM job WHERE failed = 0")
+            .fetchone()[0]
+        )
+
+
+class _Queue:
+    # the backend of one app and the worker threads consuming it, which keep the app they run the jobs with
+    def __init__(self, app, backend):
+        self.app = app
+        self.backend = backend
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+
+class TaskQueue:
+    def __init__(self, app=None):
+        self.tasks = {}
+        event.listen(db.session, "after_commit", self._enqueue_committed)
+        event.listen(db.session, "after_rollback", self._discard)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        mode = app.config["TASK_QUEUE"]
+        if mode == "sqlite":
+            backend = SqliteBackend(
+                app.config["TASK_QUEUE_PATH"], app.config["TASK_LEASE"]
+            )
+        elif mode == "memory":
+            backend = MemoryBackend()
+        else:
+            backend = None
+        app.extensions["task_queue"] = _Queue(app, backend)
+        atexit.register(self.stop, app)
+
+    def _queue(self, app=None):
+        return (app or current_app).extensions["task_queue"]
+
+    # the backend of the current app, None runs the jobs inline
+    @property
+    def backend(self):
+        return self._queue().backend
+
+    @backend.setter
+    def backend(self, backend):
+        self._queue().backend = backend
+
+    def task(self, function):
+        self.tasks[function.__name__] = function
+        return function
+
+    def enqueue(self, name, **payload):
+        queue = self._queue()
+        if queue.backend is None:
+            self._run(queue.app, Job(None, name, payload))
+            return
+        queue.backend.put(name, payload)
+        if queue.app.config["TASK_WORKERS"]:
+            self._start(queue, queue.app.config["TASK_WORKERS"])
+
+    def enqueue_after_commit(self, session, name, **payload):
+        # the job is only enqueued if the transaction of session commits
+        session.info.setdefault("_tasks", []).append((name, payload))
+
+    def _enqueue_committed(self, session):
+        for name, payload in session.info.pop("_tasks", ()):
+            self.enqueue(name, **payload)
+
+    def _discard(self, session):
+        session.info.pop("_tasks", None)
+
+    def _run(self, app, job):
+        # a new app context gets its own session so the job never commits the work of a request
+        with app.app_context():
+            try:
+                self.tasks[job.name](**job.payload)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def process(self, job, app=None):
+        queue = self._queue(app)
+        try:
+            self._run(queue.app, job)
+        except Exception as error:
+            attempts = job.attempts + 1
+            if attempts >= queue.app.config["TASK_MAX_ATTEMPTS"]:
+                queue.app.logger.exception(
+                    "Task %s failed after %d attempts", job.name, attempts
+                )
+                queue.backend.fail(job, repr(error))
+            else:
+                delay = queue.app.config["TASK_RETRY_DELAY"] * 2**job.attempts
+                queue.backend.retry(job, time.time() + delay, repr(error))
+            return False
+        queue.backend.ack(job)
+        return True
+
+    def work(self, stop=None, burst=False, app=None):
+        # consumes the jobs of app (the current one by default) until stop is set, or until the queue is empty with burst
+        queue = self._queue(app)
+        stop = stop or queue.stopped
+        while not stop.is_set():
+            job = queue.backend.claim(timeout=0 if burst else 1.0)
+            if job is None:
+                if burst:
+                    return
+                continue
+            self.process(job, queue.app)
+
+    def _start(self, queue, workers):
+        if queue.threads or queue.stopped.is_set():
+            return
+        with queue.lock:
+            if not queue.threads:
+                queue.threads = [
+                    threading.Thread(
+                        target=self.work,
+                        kwargs={"app": queue.app},
+                        name=f"task-worker-{i}",
+                        daemon=True,
+                    )
+                    for i in range(workers)
+                ]
+                for thread in queue.threads:
+                    thread.start()
+
+    def stop(self, app=None):
+        queue = self._queue(app)
+        queue.stopped.set()
+        for thread in queue.threads:
+            thread.join()
+        queue.threads = []
+
+
+task_queue = TaskQueue()
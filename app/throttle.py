@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import defaultdict, deque
+
+# sliding window attempt counter used to throttle the logins per username and per ip address
+# so that credential stuffing cannot spend the whole password hashing budget
+
+
+class Throttle:
+    def __init__(self):
+        self._attempts = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def _expire(self, attempts, now, window):
+        while attempts and attempts[0] <= now - window:
+            attempts.popleft()
+
+    def blocked(self, key, limit, window):
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if not attempts:
+                return False
+            self._expire(attempts, now, window)
+            return len(attempts) >= limit
+
+    def hit(self, key, window):
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts[key]
+            self._expire(attempts, now, window)
+            attempts.append(now)
+            # drop the keys that have no attempt left in their window so memory stays bounded
+            if len(self._attempts) > 10000:
+                for other in list(self._attempts):
+                    self._expire(self._attempts[other], now, window)
+                    if not self._attempts[other]:
+                        del self._attempts[other]
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+
+login_throttle = Throttle()
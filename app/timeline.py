@@ -0,0 +1,178 @@
+from flask import current_app
+from sqlalchemy import and_, delete, event, exists, insert, literal, select, tuple_
+from sqlalchemy.orm import object_session
+from . import db
+from .models import Post, User, followers, timeline
+from .tasks import task_queue
+
+# fan-out-on-write home timelines
+# every new post is pushed into the timeline of its author and of each follower, a follow backfills
+# the posts of the followed user and an unfollow removes them, so the home page only reads an ordered slice.
+# authors with at least TIMELINE_CELEBRITY_THRESHOLD followers are not fanned out, their posts are merged at read time
+# the push to the followers runs as a task of app/tasks.py after the post is committed
+
+
+def is_celebrity(connection, user_id):
+    threshold = current_app.config["TIMELINE_CELEBRITY_THRESHOLD"]
+    count = select(User.followers_count).where(User.id == user_id)
+    return connection.execute(count).scalar() >= threshold
+
+
+def followed_celebrities(user):
+    # the users followed by user whose posts are read on demand instead of being pushed
+    threshold = current_app.config["TIMELINE_CELEBRITY_THRESHOLD"]
+    return (
+        select(followers.c.followed_id)
+        .join(User, User.id == followers.c.followed_id)
+        .where(
+            followers.c.follower_id == user.id,
+            User.followers_count >= threshold,
+        )
+    )
+
+
+# the materialized timeline is paged on its own copy of the time stamp and of the post id,
+# which ix_timeline_user_id_time_stamp already returns in order
+TIMELINE_KEY = (timeline.c.time_stamp, timeline.c.post_id)
+
+
+def timeline_page(user):
+    # the timeline of user with the columns keyset_paginate orders it on
+    materialized = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+        timeline.c.user_id == user.id
+    )
+    celebrities = db.session.execute(followed_celebrities(user)).scalars().all()
+    if not celebrities:
+        return materialized.order_by(timeline.c.time_stamp.desc()), TIMELINE_KEY
+    # fan-out-on-read for the celebrities, union removes posts that were pushed before the author crossed the threshold
+    merged = Post.query.filter(Post.user_id.in_(celebrities))
+    return materialized.union(merged).order_by(Post.time_stamp.desc()), None
+
+
+def fan_out(connection, post):
+    if is_celebrity(connection, post.user_id):
+        return
+    # the job may run again after a crash, the rows already pushed are skipped
+    already_pushed = exists().where(
+        and_(
+            timeline.c.user_id == followers.c.follower_id,
+            timeline.c.post_id == post.id,
+        )
+    )
+    rows = select(
+        followers.c.follower_id,
+        literal(post.id),
+        literal(post.user_id),
+        literal(post.time_stamp),
+    ).where(followers.c.followed_id == post.user_id, ~already_pushed)
+    connection.execute(
+        insert(timeline).from_select(
+            ["user_id", "post_id", "author_id", "time_stamp"], rows
+        )
+    )
+
+
+@task_queue.task
+def fan_out_post(post_id):
+    post = db.session.get(Post, post_id)
+    if post is None:
+        return
+    fan_out(db.session.connection(), post)
+    db.session.commit()
+
+
+def backfill(user, followed):
+    if is_celebrity(db.session.connection(), followed.id):
+        return
+    already_pushed = exists().where(
+        and_(timeline.c.user_id == user.id, timeline.c.post_id == Post.id)
+    )
+    posts = select(literal(user.id), Post.id, Post.user_id, Post.time_stamp).where(
+        Post.user_id == followed.id, ~already_pushed
+    )
+    db.session.execute(
+        insert(timeline).from_select(
+            ["user_id", "post_id", "author_id", "time_stamp"], posts
+        )
+    )
+
+
+def prune(user, followed):
+    db.session.execute(
+        delete(timeline).where(
+            timeline.c.user_id == user.id, timeline.c.author_id == followed.id
+        )
+    )
+
+
+def backfill_pairs(pairs):
+    # backfill of many (follower id, followed id) pairs with one INSERT ... SELECT
+    threshold = current_app.config["TIMELINE_CELEBRITY_THRESHOLD"]
+    already_pushed = exists().where(
+        and_(
+            timeline.c.user_id == followers.c.follower_id,
+            timeline.c.post_id == Post.id,
+        )
+    )
+    posts = (
+        select(followers.c.follower_id, Post.id, Post.user_id, Post.time_stamp)
+        .join(Post, Post.user_id == followers.c.followed_id)
+        .join(User, User.id == followers.c.followed_id)
+        .where(
+            tuple_(followers.c.follower_id, followers.c.followed_id).in_(pairs),
+            User.followers_count < threshold,
+            ~already_pushed,
+        )
+    )
+    db.session.execute(
+        insert(timeline).from_select(
+            ["user_id", "post_id", "author_id", "time_stamp"], posts
+        )
+    )
+
+
+def prune_pairs(pairs):
+    db.session.execute(
+        delete(timeline).where(
+            tuple_(timeline.c.user_id, timeline.c.author_id).in_(pairs)
+        )
+    )
+
+
+def rebuild():
+    # recompute every timeline from the posts and the follow graph with two set based inserts
+    threshold = current_app.config["TIMELINE_CELEBRITY_THRESHOLD"]
+    columns = ["user_id", "post_id", "author_id", "time_stamp"]
+    db.session.execute(delete(timeline))
+    db.session.execute(
+        insert(timeline).from_select(
+            columns, select(Post.user_id, Post.id, Post.user_id, Post.time_stamp)
+        )
+    )
+    db.session.execute(
+        insert(timeline).from_select(
+            columns,
+            select(followers.c.follower_id, Post.id, Post.user_id, Post.time_stamp)
+            .join(Post, Post.user_id == followers.c.followed_id)
+            .join(User, User.id == followers.c.followed_id)
+            .where(User.followers_count < threshold),
+        )
+    )
+    db.session.commit()
+
+
+@event.listens_for(Post, "after_insert")
+def push_new_post(mapper, connection, post):
+    if current_app.config["TIMELINE_MATERIALIZED"]:
+        # the author sees the post right away, the followers get it from a background job once it is committed
+        connection.execute(
+            insert(timeline).values(
+                user_id=post.user_id,
+                post_id=post.id,
+                author_id=post.user_id,
+                time_stamp=post.time_stamp,
+            )
+        )
+        task_queue.enqueue_after_commit(
+            object_session(post), "fan_out_post", post_id=post.id
+        )
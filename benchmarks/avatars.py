@@ -0,0 +1,75 @@
+# render time of a page of posts with the avatar url hashed on every call (before)
+# and with the stored email hash and memoized urls (after)
+# the fragment cache is bypassed, every post block is rendered
+#
+#   python -m benchmarks.avatars --posts 25 --repeat 2000
+
+import argparse
+import os
+import time
+from hashlib import md5
+
+
+def legacy_avatar(user, size):
+    email_md5_hash = md5(user.email.lower().encode("utf-8")).hexdigest()
+    return f"https://www.gravatar.com/avatar/{email_md5_hash}?d=identicon&s={size}"
+
+
+def timing(render, repeat):
+    render()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        render()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Avatar url cost on a page of posts")
+    parser.add_argument("--posts", type=int, default=25)
+    parser.add_argument("--authors", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    from flask import render_template
+    from app import create_app
+    from app.models import Post, User
+
+    app = create_app()
+
+    authors = [
+        User(username=f"user{i}", email=f"User{i}@Example.com")
+        for i in range(args.authors)
+    ]
+    posts = [
+        Post(id=i, body=f"post {i}", author=authors[i % len(authors)])
+        for i in range(args.posts)
+    ]
+
+    def render():
+        for post in posts:
+            render_template("_post.html", post=post)
+
+    with app.test_request_context("/explore"):
+        current = User.avatar
+        try:
+            User.avatar = legacy_avatar
+            before = timing(render, args.repeat)
+        finally:
+            User.avatar = current
+        after = timing(render, args.repeat)
+        hashed = timing(
+            lambda: [legacy_avatar(p.author, 36) for p in posts], args.repeat
+        )
+        memoized = timing(lambda: [p.author.avatar(36) for p in posts], args.repeat)
+
+    print(f"== {args.posts} posts page")
+    print(f"  before: {before:8.3f} ms")
+    print(f"   after: {after:8.3f} ms")
+    print("== avatar urls of the page")
+    print(f"  before: {hashed * 1000:8.3f} us")
+    print(f"   after: {memoized * 1000:8.3f} us")
+
+
+if __name__ == "__main__":
+    main()
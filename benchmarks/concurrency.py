@@ -0,0 +1,132 @@
+# read/write concurrency of a file sqlite database with the default connection settings (before)
+# and with the production profile of app/database.py (after)
+# reader threads run the explore query while writer threads update last_seen and insert posts like the web workers do
+#
+#   python -m benchmarks.concurrency --readers 8 --writers 2 --seconds 5
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, insert, select, update
+from sqlalchemy.exc import OperationalError
+
+
+def seed(engine, users, posts, rng):
+    from app.models import Post, User
+
+    with engine.begin() as connection:
+        connection.execute(
+            insert(User),
+            [
+                {"username": f"user{i}", "email": f"user{i}@example.com"}
+                for i in range(1, users + 1)
+            ],
+        )
+        connection.execute(
+            insert(Post),
+            [
+                {"body": f"post {i}", "user_id": rng.randint(1, users)}
+                for i in range(posts)
+            ],
+        )
+
+
+def run(engine, readers, writers, seconds, users, seed_value):
+    from app.models import Post, User
+
+    explore = (
+        select(Post.id, Post.body, User.username)
+        .join(User, User.id == Post.user_id)
+        .order_by(Post.time_stamp.desc())
+        .limit(25)
+    )
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    latencies = {"reads": [], "writes": []}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(kind, rng):
+        with engine.connect() as connection:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    if kind == "reads":
+                        connection.execute(explore).all()
+                        connection.rollback()
+                    else:
+                        user_id = rng.randint(1, users)
+                        connection.execute(
+                            update(User)
+                            .where(User.id == user_id)
+                            .values(last_seen=datetime.utcnow())
+                        )
+                        if rng.random() < 0.1:
+                            connection.execute(
+                                insert(Post).values(body="new post", user_id=user_id)
+                            )
+                        connection.commit()
+                except OperationalError:
+                    connection.rollback()
+                    with lock:
+                        counts["locked"] += 1
+                    continue
+                elapsed = time.perf_counter() - start
+                with lock:
+                    counts[kind] += 1
+                    latencies[kind].append(elapsed)
+
+    threads = [
+        threading.Thread(target=worker, args=(kind, random.Random(seed_value + i)))
+        for i, kind in enumerate(["reads"] * readers + ["writes"] * writers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for kind, values in latencies.items():
+        values.sort()
+        p95 = values[int(len(values) * 0.95)] * 1000 if values else 0.0
+        counts[kind + "_p95_ms"] = round(p95, 3)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite read/write concurrency")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    from app import create_app, db
+    from app.database import configure_engine
+
+    app = create_app()
+
+    folder = tempfile.mkdtemp()
+    threads = args.readers + args.writers
+    for profile in ("default", "production"):
+        path = os.path.join(folder, f"{profile}.db")
+        engine = create_engine("sqlite:///" + path, pool_size=threads, max_overflow=0)
+        configure_engine(engine, {**app.config, "DATABASE_PROFILE": profile})
+        db.metadata.create_all(engine)
+        seed(engine, args.users, args.posts, random.Random(args.seed))
+        result = run(
+            engine, args.readers, args.writers, args.seconds, args.users, args.seed
+        )
+        engine.dispose()
+        print(f"== {profile}")
+        for name, value in result.items():
+            print(f"  {name:>14}: {value}")
+
+
+if __name__ == "__main__":
+    main()
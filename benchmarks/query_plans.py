@@ -0,0 +1,146 @@
+# compares the query plans and timings of the hot follow graph and profile queries
+# on the schema before and after the followers primary key and the post (user_id, time_stamp) index
+#
+#   python benchmarks/query_plans.py --users 2000 --follows 50 --posts 100000
+
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+USER_TABLE = """
+CREATE TABLE user (
+    id INTEGER NOT NULL PRIMARY KEY,
+    username VARCHAR(64),
+    email VARCHAR(120)
+);
+CREATE UNIQUE INDEX ix_user_username ON user (username);
+CREATE UNIQUE INDEX ix_user_email ON user (email);
+"""
+
+POST_TABLE = """
+CREATE TABLE post (
+    id INTEGER NOT NULL PRIMARY KEY,
+    body VARCHAR(140),
+    time_stamp DATETIME,
+    user_id INTEGER REFERENCES user (id)
+);
+CREATE INDEX ix_post_time_stamp ON post (time_stamp);
+"""
+
+BEFORE = (
+    USER_TABLE
+    + POST_TABLE
+    + """
+CREATE TABLE followers (
+    follower_id INTEGER REFERENCES user (id),
+    followed_id INTEGER REFERENCES user (id)
+);
+"""
+)
+
+AFTER = (
+    USER_TABLE
+    + POST_TABLE
+    + """
+CREATE INDEX ix_post_user_id_time_stamp ON post (user_id, time_stamp);
+CREATE TABLE followers (
+    follower_id INTEGER NOT NULL REFERENCES user (id),
+    followed_id INTEGER NOT NULL REFERENCES user (id),
+    PRIMARY KEY (follower_id, followed_id)
+);
+CREATE INDEX ix_followers_followed_id_follower_id ON followers (followed_id, follower_id);
+"""
+)
+
+# the statements emitted by User.followed_posts, User.is_following and the user_profile posts query
+QUERIES = {
+    "followed_posts": """
+        SELECT * FROM (
+            SELECT post.* FROM post JOIN followers ON followers.followed_id = post.user_id
+            WHERE followers.follower_id = :user
+            UNION
+            SELECT post.* FROM post WHERE post.user_id = :user
+        ) ORDER BY time_stamp DESC LIMIT 26
+    """,
+    "is_following": """
+        SELECT count(*) FROM user, followers
+        WHERE user.id = followers.followed_id
+        AND followers.follower_id = :user AND followers.followed_id = :other
+    """,
+    "followers_of": """
+        SELECT count(*) FROM followers WHERE followers.followed_id = :user
+    """,
+    "user_profile_posts": """
+        SELECT * FROM post WHERE post.user_id = :user
+        ORDER BY post.time_stamp DESC, post.id DESC LIMIT 26
+    """,
+}
+
+
+def seed(connection, users, follows, posts, rng):
+    connection.executemany(
+        "INSERT INTO user (id, username, email) VALUES (?, ?, ?)",
+        ((i, f"user{i}", f"user{i}@example.com") for i in range(1, users + 1)),
+    )
+    edges = set()
+    for follower in range(1, users + 1):
+        for followed in rng.sample(range(1, users + 1), min(follows, users)):
+            if followed != follower:
+                edges.add((follower, followed))
+    connection.executemany(
+        "INSERT INTO followers (follower_id, followed_id) VALUES (?, ?)", sorted(edges)
+    )
+    start = datetime(2023, 1, 1)
+    connection.executemany(
+        "INSERT INTO post (body, time_stamp, user_id) VALUES (?, ?, ?)",
+        (
+            (f"post {i}", start + timedelta(seconds=i), rng.randint(1, users))
+            for i in range(posts)
+        ),
+    )
+    connection.commit()
+    connection.execute("ANALYZE")
+
+
+def plan(connection, sql, params):
+    rows = connection.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def timing(connection, sql, params, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        connection.execute(sql, params).fetchall()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query plans before and after the indexes")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--follows", type=int, default=50)
+    parser.add_argument("--posts", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    databases = {}
+    for name, schema in (("before", BEFORE), ("after", AFTER)):
+        connection = sqlite3.connect(":memory:")
+        connection.executescript(schema)
+        seed(connection, args.users, args.follows, args.posts, random.Random(args.seed))
+        databases[name] = connection
+
+    params = {"user": 1, "other": 2}
+    for query, sql in QUERIES.items():
+        print(f"== {query}")
+        for name, connection in databases.items():
+            ms = timing(connection, sql, params, args.repeat)
+            print(f"  {name:>6}: {ms:8.3f} ms")
+            for step in plan(connection, sql, params):
+                print(f"          {step}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# load test of the hot routes on a seeded database
+# reports p50/p95/p99 latency, queries per request and throughput for every scenario,
+# and fails when a scenario regresses against a stored JSON baseline
+#
+#   python -m benchmarks.run                                 # flask test client, one request at a time
+#   python -m benchmarks.run --wsgi --concurrency 8          # threads against a local wsgi server
+#   python -m benchmarks.run --save-baseline benchmarks/baselines/default.json
+#   python -m benchmarks.run --baseline benchmarks/baselines/default.json
+
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+SCENARIOS = ("index", "explore", "user_profile", "login", "follow")
+
+
+class ClientSession:
+    # a logged in flask test client
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data=None):
+        return self.client.post(path, data=data or {}).status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    # a cookie keeping http client talking to the local wsgi server
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirect(),
+        )
+
+    def _open(self, request):
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    def get(self, path):
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, data=None):
+        body = urllib.parse.urlencode(data or {}).encode("utf-8")
+        return self._open(urllib.request.Request(self.base_url + path, data=body))
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def login(session, username, password):
+    status = session.post("/login", {"username": username, "password": password})
+    if status != 302:
+        raise RuntimeError(f"could not log in {username} : {status}")
+
+
+def make_request(scenario, session, rng, users, password):
+    # returns the function doing one request of the scenario with the given session
+    username = f"user{rng.randint(1, users)}"
+    if scenario == "index":
+        return lambda: session.get("/index")
+    if scenario == "explore":
+        return lambda: session.get("/explore")
+    if scenario == "user_profile":
+        return lambda: session.get(f"/user/{username}")
+    if scenario == "login":
+
+        def login_request():
+            status = session.post(
+                "/login", {"username": username, "password": password}
+            )
+            session.get("/logout")
+            return status
+
+        return login_request
+    if scenario == "follow":
+
+        def follow_request():
+            status = session.post(f"/follow/{username}")
+            session.post(f"/unfollow/{username}")
+            return status
+
+        return follow_request
+    raise ValueError(scenario)
+
+
+def run_scenario(scenario, sessions, requests, counter, rng, users, password):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_session = max(1, requests // len(sessions))
+
+    def worker(session, seed):
+        worker_rng = random.Random(seed)
+        for _ in range(per_session):
+            request = make_request(scenario, session, worker_rng, users, password)
+            start = time.perf_counter()
+            status = request()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                if status >= 400:
+                    errors.append(status)
+
+    queries = counter.count
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=worker, args=(session, rng.random()))
+        for session in sessions
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done = len(latencies)
+    return {
+        "requests": done,
+        "errors": len(errors),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "queries_per_request": round((counter.count - queries) / done, 2),
+        "throughput_rps": round(done / elapsed, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # a scenario regresses when its p95 latency grows past the tolerance or when it needs more queries
+    failures = []
+    for scenario, base in baseline["scenarios"].items():
+        current = results["scenarios"].get(scenario)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            failures.append(
+                f"{scenario}: p95 {current['p95_ms']} ms > {base['p95_ms']} ms + {tolerance:.0%}"
+            )
+        if current["queries_per_request"] > base["queries_per_request"]:
+            failures.append(
+                f"{scenario}: {current['queries_per_request']} queries per request > {base['queries_per_request']}"
+            )
+        if current["errors"] > base.get("errors", 0):
+            failures.append(f"{scenario}: {current['errors']} failed requests")
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot routes")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--follows", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--login-requests", type=int, default=20)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--wsgi", action="store_true", help="load a local wsgi server")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save-baseline", help="write the results as a JSON baseline")
+    parser.add_argument("--output", help="write the results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # the config reads the database url from the environment when it is imported
+    os.environ.setdefault(
+        "DATABASE_URL",
+        "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db"),
+    )
+    # the in process caches would otherwise expire a few seconds into the run (see config.py),
+    # the queries per request must not depend on how long the run takes
+    os.environ.setdefault("USER_CACHE_TTL", "300")
+    os.environ.setdefault("FOLLOWED_CACHE_TTL", "300")
+    from app import create_app, db
+    from benchmarks.seed import PASSWORD, seed
+
+    app = create_app()
+
+    app.config["WTF_CSRF_ENABLED"] = False
+    # every simulated client logs in from 127.0.0.1
+    app.config["LOGIN_ATTEMPTS_PER_IP"] = 1000000
+    with app.app_context():
+        seeded = seed(args.users, args.posts, args.follows, random_seed=args.seed)
+        counter = QueryCounter(db.engine)
+
+    server = None
+    if args.wsgi:
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.port}"
+        new_session = lambda: HttpSession(base_url)
+        concurrency = args.concurrency
+    else:
+        new_session = lambda: ClientSession(app)
+        concurrency = 1
+
+    rng = random.Random(args.seed)
+    sessions = []
+    for i in range(concurrency):
+        session = new_session()
+        login(session, f"user{i + 1}", PASSWORD)
+        sessions.append(session)
+
+    results = {
+        "mode": "wsgi" if args.wsgi else "client",
+        "concurrency": concurrency,
+        "data": seeded,
+        "scenarios": {},
+    }
+    for scenario in args.scenarios:
+        if scenario == "login":
+            anonymous = [new_session() for _ in sessions]
+            result = run_scenario(
+                scenario,
+                anonymous,
+                args.login_requests,
+                counter,
+                rng,
+                args.users,
+                PASSWORD,
+            )
+        else:
+            result = run_scenario(
+                scenario, sessions, args.requests, counter, rng, args.users, PASSWORD
+            )
+        results["scenarios"][scenario] = result
+        print(
+            f"{scenario:>13}: p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  "
+            f"p99 {result['p99_ms']:8.2f} ms  {result['queries_per_request']:5.1f} q/req  "
+            f"{result['throughput_rps']:7.1f} req/s  {result['errors']} errors"
+        )
+
+    if server is not None:
+        server.shutdown()
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+# compares the fts5 search backend with the LIKE scan on a synthetic post table
+# the index is built in bulk with the same rebuild as "flask search reindex"
+#
+#   python -m benchmarks.search --posts 100000 --repeat 20
+
+import argparse
+import os
+import random
+import time
+
+WORDS = [f"word{i}" for i in range(5000)]
+
+
+def timing(search, terms, repeat):
+    search(terms)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        search(terms)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FTS5 search against a LIKE scan")
+    parser.add_argument("--posts", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = "sqlite://"
+    from sqlalchemy import insert
+    from app import create_app, db
+    from app.models import Post, User
+    from app.search import Fts5Backend, LikeBackend
+
+    app = create_app()
+
+    rng = random.Random(args.seed)
+    # zipf like word frequencies so that some terms are common and most are rare
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username="author", email="author@example.com"))
+        db.session.commit()
+        rows = [
+            {"body": " ".join(rng.choices(WORDS, weights, k=12)), "user_id": 1}
+            for _ in range(args.posts)
+        ]
+        db.session.execute(insert(Post), rows)
+        db.session.commit()
+        with db.engine.begin() as connection:
+            Fts5Backend().rebuild(connection)
+
+        per_page = app.config["POSTS_PER_PAGE"]
+        backends = {"like": LikeBackend(), "fts5": Fts5Backend()}
+        for terms in (["word0"], ["word50"], ["word4000"], ["word3", "word70"]):
+            print(f"== {' '.join(terms)}")
+            for name, backend in backends.items():
+                ms = timing(
+                    lambda terms: backend.search(terms, per_page), terms, args.repeat
+                )
+                print(f"  {name:>6}: {ms:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
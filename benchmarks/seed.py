@@ -0,0 +1,106 @@
+# synthetic data generator for the benchmarks
+# creates N users, a power-law follow graph (a few users are followed by many, most by few) and M posts
+#
+#   DATABASE_URL=sqlite:///bench.db python -m benchmarks.seed --users 1000 --posts 20000
+
+import argparse
+import random
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+PASSWORD = "benchmark"
+
+
+def power_law_follows(users, average, exponent, rng):
+    # the weight of the user of rank r is 1 / r ** exponent, each user follows a number of users
+    # drawn around the average so both the in and the out degrees are skewed
+    ids = list(range(1, users + 1))
+    weights = [1 / rank**exponent for rank in range(1, users + 1)]
+    edges = set()
+    for follower in ids:
+        wanted = min(users - 1, int(rng.paretovariate(2) * average / 2))
+        for followed in rng.choices(ids, weights=weights, k=wanted):
+            if followed != follower:
+                edges.add((follower, followed))
+    return edges
+
+
+def seed(users=1000, posts=20000, follows=20, exponent=1.1, random_seed=42):
+    from app import db, timeline
+    from app.models import Post, User, followers, rebuild_counters
+
+    rng = random.Random(random_seed)
+    db.drop_all()
+    db.create_all()
+    # every user gets the same password so hashing only runs once
+    hashed_password = generate_password_hash(PASSWORD)
+    db.session.execute(
+        insert(User),
+        [
+            {
+                "id": i,
+                "username": f"user{i}",
+                "email": f"user{i}@example.com",
+                "hashed_password": hashed_password,
+            }
+            for i in range(1, users + 1)
+        ],
+    )
+    edges = power_law_follows(users, follows, exponent, rng)
+    db.session.execute(
+        insert(followers),
+        [{"follower_id": a, "followed_id": b} for a, b in sorted(edges)],
+    )
+    start = datetime.utcnow() - timedelta(seconds=posts)
+    db.session.execute(
+        insert(Post),
+        [
+            {
+                "body": f"post {i} "
+                + " ".join(rng.choices(WORDS, k=rng.randint(3, 20))),
+                "time_stamp": start + timedelta(seconds=i),
+                "user_id": rng.randint(1, users),
+            }
+            for i in range(posts)
+        ],
+    )
+    db.session.commit()
+    rebuild_counters()
+    if current_app.config["TIMELINE_MATERIALIZED"]:
+        timeline.rebuild()
+    return {"users": users, "follows": len(edges), "posts": posts}
+
+
+WORDS = (
+    "flask python blog post today great idea coffee morning code review deploy "
+    "database index query cache timeline follow friend weekend travel music book "
+    "learning test bug fix release night city rain sun"
+).split()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Seed the database with synthetic data"
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument(
+        "--follows", type=int, default=20, help="average follows per user"
+    )
+    parser.add_argument(
+        "--exponent", type=float, default=1.1, help="power-law exponent"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    from app import create_app
+
+    with create_app().app_context():
+        counts = seed(args.users, args.posts, args.follows, args.exponent, args.seed)
+    print("Seeded {users} users, {follows} follows and {posts} posts".format(**counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# concurrent connection throughput of the read routes (index, explore, user_profile)
+# served one request at a time like a sync worker, and with a thread per connection like a gthread worker
+# --db-latency-ms adds a wait to every query to model a database reached over the network,
+# the time a sync worker spends waiting instead of serving
+#
+#   python -m benchmarks.serving --concurrency 16 --seconds 5 --db-latency-ms 2
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from benchmarks.run import HttpSession, login, make_request, percentile
+
+SCENARIOS = ("index", "explore", "user_profile")
+
+
+def serve(app, threaded, clients, seconds, users, password, rng):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app, threaded=threaded)
+    # connections beyond the listen backlog would be refused instead of waiting
+    server.socket.listen(clients * 2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.port}"
+    sessions = []
+    for i in range(clients):
+        session = HttpSession(base_url)
+        login(session, f"user{i % users + 1}", password)
+        sessions.append(session)
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(session, seed):
+        client_rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            scenario = client_rng.choice(SCENARIOS)
+            request = make_request(scenario, session, client_rng, users, password)
+            start = time.perf_counter()
+            status = request()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                if status >= 400:
+                    errors.append(status)
+
+    threads = [
+        threading.Thread(target=client, args=(session, rng.random()))
+        for session in sessions
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync and threaded serving")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--follows", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--db-latency-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ.setdefault(
+        "DATABASE_URL",
+        "sqlite:///" + os.path.join(tempfile.mkdtemp(), "serving.db"),
+    )
+    from sqlalchemy import event
+    from app import create_app, db
+    from benchmarks.seed import PASSWORD, seed
+
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["LOGIN_ATTEMPTS_PER_IP"] = 1000000
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    with app.app_context():
+        seed(args.users, args.posts, args.follows, random_seed=args.seed)
+        if args.db_latency_ms:
+
+            @event.listens_for(db.engine, "before_cursor_execute")
+            def network_round_trip(*_):
+                time.sleep(args.db_latency_ms / 1000)
+
+    for name, threaded in (("sync", False), ("threaded", True)):
+        result = serve(
+            app,
+            threaded,
+            args.concurrency,
+            args.seconds,
+            args.users,
+            PASSWORD,
+            random.Random(args.seed),
+        )
+        print(f"== {name}, {args.concurrency} concurrent connections")
+        for key, value in result.items():
+            print(f"  {key:>14}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# startup cost and memory of a web worker
+# every measure runs in a fresh interpreter : the time to import the app package and to create the app, and its rss.
+# it is measured twice, once importing flask-migrate (and alembic) first like the app did before the migration
+# commands were lazy.
+# then a master preloads the app and forks workers that serve requests, like gunicorn with preload_app,
+# and the memory private to each worker is read from /proc/self/smaps_rollup (linux only), with and without gc.freeze()
+#
+#   python -m benchmarks.startup --repeat 10 --workers 4
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+STARTUP = """
+import json, time
+start = time.perf_counter()
+if {eager}:
+    import flask_migrate
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+rss = 0
+with open("/proc/self/status") as status:
+    for line in status:
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1]) / 1024
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "rss_mb": rss,
+}}))
+"""
+
+PREFORK = """
+import gc, json, os
+from app import create_app, db
+from app.models import Post, User
+app = create_app()
+app.config["RESPONSE_CACHE_TTL"] = 0
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+    user = User(username="author", email="author@example.com")
+    db.session.add(user)
+    db.session.add_all([Post(body=f"post {{i}}", author=user) for i in range(200)])
+    db.session.commit()
+    db.engine.dispose()
+if {freeze}:
+    gc.freeze()
+
+
+def private_memory():
+    values = {{}}
+    with open("/proc/self/smaps_rollup") as smaps:
+        for line in smaps:
+            name, _, rest = line.partition(":")
+            if name in ("Pss", "Private_Clean", "Private_Dirty"):
+                values[name] = int(rest.split()[0]) / 1024
+    return {{"uss_mb": values["Private_Clean"] + values["Private_Dirty"], "pss_mb": values["Pss"]}}
+
+
+readers = []
+for _ in range({workers}):
+    read, write = os.pipe()
+    if os.fork() == 0:
+        os.close(read)
+        client = app.test_client()
+        for _ in range({requests}):
+            client.get("/explore")
+        os.write(write, json.dumps(private_memory()).encode())
+        os._exit(0)
+    os.close(write)
+    readers.append(read)
+results = []
+for read in readers:
+    with os.fdopen(read) as pipe:
+        results.append(json.loads(pipe.read()))
+    os.wait()
+print(json.dumps(results))
+"""
+
+
+def run(code, env):
+    output = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True
+    )
+    if output.returncode:
+        raise RuntimeError(output.stderr)
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker startup time and memory")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    env = {
+        **os.environ,
+        "DATABASE_URL": "sqlite:///" + os.path.join(folder, "startup.db"),
+        "LOG_DIR": os.path.join(folder, "logs"),
+        "PYTHONPATH": os.getcwd(),
+    }
+    for eager in (True, False):
+        runs = [run(STARTUP.format(eager=eager), env) for _ in range(args.repeat)]
+        print(f"== startup, {'eager' if eager else 'lazy'} migration commands")
+        for name in runs[0]:
+            values = [result[name] for result in runs]
+            print(f"  {name:>14}: median {statistics.median(values):8.1f}")
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        return
+    for freeze in (False, True):
+        code = PREFORK.format(
+            freeze=freeze, workers=args.workers, requests=args.requests
+        )
+        workers = run(code, env)
+        print(f"== {args.workers} forked workers, gc.freeze() {freeze}")
+        for name in workers[0]:
+            values = [worker[name] for worker in workers]
+            print(f"  {name:>14}: mean {statistics.mean(values):8.1f}")
+
+
+if __name__ == "__main__":
+    main()
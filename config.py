@@ -15,11 +15,140 @@ class Config(object):
     # this is to get a performance boost and not get notifications each time there is a change in the database
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # optional read only replica of the database, the GET requests read from it (see app/replica.py)
+    REPLICA_DATABASE_URL = os.environ.get("REPLICA_DATABASE_URL")
+    SQLALCHEMY_BINDS = {"replica": REPLICA_DATABASE_URL} if REPLICA_DATABASE_URL else {}
+    # seconds the replica may lag behind the primary, a browser that wrote reads from the primary for that long
+    REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG") or 5)
+
+    # "production" tunes every sqlite connection (see app/database.py), any other value keeps the sqlite defaults
+    DATABASE_PROFILE = os.environ.get("DATABASE_PROFILE") or "production"
+    SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE") or "WAL"
+    SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS") or "NORMAL"
+    # milliseconds a connection waits for a lock before failing with "database is locked"
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS") or 5000)
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE") or 256 * 1024 * 1024)
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB") or 64 * 1024)
+
+    # connection pool of the server databases (postgresql, mysql), sqlite keeps the pool chosen by sqlalchemy
+    DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE") or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW") or 20)
+    # seconds after which a connection is replaced, below the idle timeout of the server
+    DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE") or 1800)
+    DATABASE_POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT") or 30)
+    SQLALCHEMY_ENGINE_OPTIONS = (
+        {}
+        if SQLALCHEMY_DATABASE_URI.startswith("sqlite")
+        else {
+            "pool_size": DATABASE_POOL_SIZE,
+            "max_overflow": DATABASE_MAX_OVERFLOW,
+            "pool_recycle": DATABASE_POOL_RECYCLE,
+            "pool_timeout": DATABASE_POOL_TIMEOUT,
+            # a connection dropped by the server is replaced before it is handed to a request
+            "pool_pre_ping": True,
+        }
+    )
+
     TEMPLATES_AUTO_RELOAD = True
 
     # pagination configuration
     POSTS_PER_PAGE = 25
 
+    # home timeline configuration
+    # when enabled posts are pushed into the timelines of the followers at write time instead of running the union query on read
+    TIMELINE_MATERIALIZED = os.environ.get("TIMELINE_MATERIALIZED") is not None
+    # authors with at least this many followers are not fanned out, their posts are merged when the timeline is read
+    TIMELINE_CELEBRITY_THRESHOLD = int(
+        os.environ.get("TIMELINE_CELEBRITY_THRESHOLD") or 10000
+    )
+
+    # seconds shared caches may serve the anonymous explore pages without asking again
+    PUBLIC_PAGE_MAX_AGE = int(os.environ.get("PUBLIC_PAGE_MAX_AGE") or 30)
+
+    # whole page cache of the anonymous explore pages : seconds a page is fresh (0 disables the cache),
+    # seconds it is still served while being rendered again, number of pages kept and seconds to wait for a page being rendered
+    RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL") or 5)
+    RESPONSE_CACHE_STALE = float(os.environ.get("RESPONSE_CACHE_STALE") or 30)
+    RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE") or 256)
+    RESPONSE_CACHE_WAIT = 5
+
+    # most usernames accepted by one bulk follow or unfollow request
+    FOLLOW_BATCH_MAX = int(os.environ.get("FOLLOW_BATCH_MAX") or 1000)
+
+    # full text search backend : "fts5" (sqlite only) or "like", by default fts5 on sqlite and like on the other databases
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND")
+
+    # rows read per query by the exports
+    EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE") or 1000)
+
+    # json api : items per page by default and at most, ids accepted by one batch request
+    API_PER_PAGE = int(os.environ.get("API_PER_PAGE") or 25)
+    API_MAX_PER_PAGE = int(os.environ.get("API_MAX_PER_PAGE") or 100)
+    API_BATCH_MAX = int(os.environ.get("API_BATCH_MAX") or 100)
+
+    # background jobs (see app/tasks.py) : "inline", "memory" or "sqlite" for a durable queue in TASK_QUEUE_PATH
+    TASK_QUEUE = os.environ.get("TASK_QUEUE") or "memory"
+    TASK_QUEUE_PATH = os.environ.get("TASK_QUEUE_PATH") or os.path.join(basedir, "tasks.db")
+    # worker threads started in the web process (0 leaves the jobs to "flask worker")
+    TASK_WORKERS = int(os.environ.get("TASK_WORKERS") or 2)
+    # runs of a failing job before it is given up, seconds before the first retry (doubled at each retry)
+    # and seconds a claimed job of the sqlite queue is hidden from the other workers
+    TASK_MAX_ATTEMPTS = int(os.environ.get("TASK_MAX_ATTEMPTS") or 5)
+    TASK_RETRY_DELAY = float(os.environ.get("TASK_RETRY_DELAY") or 1)
+    TASK_LEASE = int(os.environ.get("TASK_LEASE") or 60)
+
+    # number of rendered posts kept by the fragment cache
+    FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE") or 5000)
+
+    # password hashing configuration
+    # the method is passed to werkzeug's generate_password_hash and must include its parameters (e.g. the iterations)
+    # so that hashes made with other parameters can be detected and replaced at login
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD") or "pbkdf2:sha256:600000"
+    # processes hashing passwords (0 hashes in the request thread) and hashes allowed to wait for one
+    HASH_POOL_WORKERS = int(os.environ.get("HASH_POOL_WORKERS") or 2)
+    HASH_QUEUE_DEPTH = int(os.environ.get("HASH_QUEUE_DEPTH") or 8)
+    HASH_TIMEOUT = float(os.environ.get("HASH_TIMEOUT") or 10)
+    HASH_RETRY_AFTER = 2
+    # login attempts allowed per ip address and failed attempts allowed per username in the window (seconds)
+    LOGIN_ATTEMPTS_PER_IP = int(os.environ.get("LOGIN_ATTEMPTS_PER_IP") or 30)
+    LOGIN_ATTEMPTS_PER_USERNAME = int(os.environ.get("LOGIN_ATTEMPTS_PER_USERNAME") or 5)
+    LOGIN_ATTEMPT_WINDOW = int(os.environ.get("LOGIN_ATTEMPT_WINDOW") or 300)
+
+    # last seen configuration
+    # the last seen times are buffered in memory and written in bulk every LAST_SEEN_FLUSH_INTERVAL seconds (0 disables the flusher thread)
+    # or as soon as LAST_SEEN_FLUSH_SIZE users are waiting to be written
+    LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get("LAST_SEEN_FLUSH_INTERVAL") or 10)
+    LAST_SEEN_FLUSH_SIZE = int(os.environ.get("LAST_SEEN_FLUSH_SIZE") or 500)
+
+    # user cache configuration
+    # users restored by flask-login are cached in process, set USER_CACHE_URL to a redis url to share the cache between workers
+    # a process only drops the rows changed by its own requests, the other workers keep serving an edited user until
+    # the ttl runs out : without a shared cache the rows are kept a few seconds, a server running a single process
+    # can raise USER_CACHE_TTL
+    USER_CACHE_URL = os.environ.get("USER_CACHE_URL")
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE") or 1024)
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL") or (300 if USER_CACHE_URL else 5))
+
+    # cache of the ids followed by each user used by is_following, same settings (and same ttl tradeoff) as the user cache
+    # users following more than FOLLOWED_CACHE_MAX_DEGREE users are not cached
+    FOLLOWED_CACHE_URL = os.environ.get("FOLLOWED_CACHE_URL")
+    FOLLOWED_CACHE_SIZE = int(os.environ.get("FOLLOWED_CACHE_SIZE") or 10000)
+    FOLLOWED_CACHE_TTL = int(os.environ.get("FOLLOWED_CACHE_TTL") or (300 if FOLLOWED_CACHE_URL else 5))
+    FOLLOWED_CACHE_MAX_DEGREE = int(os.environ.get("FOLLOWED_CACHE_MAX_DEGREE") or 5000)
+
+    # instrumentation configuration
+    # when enabled every response gets a Server-Timing header, a json log line and is counted in /metrics
+    INSTRUMENTATION_ENABLED = os.environ.get("INSTRUMENTATION_ENABLED") is not None
+    # queries slower than this many milliseconds are logged with their statement
+    SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS") or 100)
+
+    # logging configuration : folder of the rotating log file, its size in bytes before it rotates and the number of old files kept
+    LOG_DIR = os.environ.get("LOG_DIR") or "logs"
+    LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES") or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT") or 10)
+    # the errors are mailed to the admins as one digest at most every this many seconds
+    LOG_MAIL_INTERVAL = float(os.environ.get("LOG_MAIL_INTERVAL") or 60)
+
     # email configuration
 
     EMAIL_SERVER = os.environ.get("EMAIL_SERVER")
@@ -0,0 +1,43 @@
+# gunicorn settings : gunicorn -c gunicorn.conf.py microblog:app
+# the master imports and creates the app once and forks the workers from it, so they start without importing anything
+# and share its memory pages until they write to them (copy on write)
+
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND") or "127.0.0.1:8000"
+workers = int(os.environ.get("GUNICORN_WORKERS") or multiprocessing.cpu_count() * 2 + 1)
+preload_app = True
+# each worker serves GUNICORN_THREADS connections at once, a request waiting on the database or on a slow client
+# holds one thread instead of the whole worker (see benchmarks/serving.py)
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS") or 4)
+
+
+def when_ready(server):
+    # the objects of the preloaded app live as long as the workers, moving them out of the collected generations
+    # keeps the garbage collector of every worker from writing to their pages and copying them
+    gc.freeze()
+    # the in process caches of the workers do not see the changes made by the other workers (see config.py)
+    from microblog import app
+
+    for name in ("USER", "FOLLOWED"):
+        url, ttl = app.config[f"{name}_CACHE_URL"], app.config[f"{name}_CACHE_TTL"]
+        if server.cfg.workers > 1 and not url and ttl > 5:
+            server.log.warning(
+                "%s_CACHE_TTL is %s seconds without a shared %s_CACHE_URL, "
+                "the workers can serve stale entries that long",
+                name,
+                ttl,
+                name,
+            )
+
+
+def post_fork(server, worker):
+    # the pooled connections of the master, if any, must not be shared with the workers
+    from app import db
+    from microblog import app
+
+    with app.app_context():
+        db.engine.dispose(close=False)
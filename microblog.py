@@ -1,6 +1,8 @@
-from app import app,db
+from app import create_app,db
 from app.models import User,Post
 
+app = create_app()
+
 #define the variables that will be pre-imported when running the flask shell 
 @app.shell_context_processor
 def make_shell_context():
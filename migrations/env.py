@@ -51,6 +51,14 @@ def get_metadata():
     return target_db.metadata
 
 
+# the fts5 search index (app/search.py) is a virtual table and its shadow tables,
+# they are created by a migration and are not in the metadata of the models
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'table' and reflected and name.startswith('post_fts'):
+        return False
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -65,7 +73,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=get_metadata(), literal_binds=True
+        url=url, target_metadata=get_metadata(), literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -97,6 +106,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,57 @@
+"""followers primary key and indexes
+
+Revision ID: 0660ff6453d5
+Revises: 5deb676f0cfb
+Create Date: 2026-10-18 10:41:27.602341
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0660ff6453d5'
+down_revision = '5deb676f0cfb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the followers table is copied into a new table with a primary key, duplicated and incomplete rows are dropped on the way
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute(
+        'INSERT INTO followers_new (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id_time_stamp', ['user_id', 'time_stamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_user_id_time_stamp')
+
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute(
+        'INSERT INTO followers_old (follower_id, followed_id) '
+        'SELECT follower_id, followed_id FROM followers'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
@@ -0,0 +1,34 @@
+"""post search index
+
+Revision ID: 7bae1953df5f
+Revises: b6d515ff762f
+Create Date: 2026-10-18 20:02:37.918245
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7bae1953df5f'
+down_revision = 'b6d515ff762f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the fts5 index only exists on sqlite, the other databases use the like search backend
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts "
+        "USING fts5(body, content='post', content_rowid='id')"
+    )
+    # index the existing posts
+    op.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("DROP TABLE IF EXISTS post_fts")
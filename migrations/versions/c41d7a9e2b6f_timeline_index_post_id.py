@@ -0,0 +1,29 @@
+"""timeline index post id
+
+Revision ID: c41d7a9e2b6f
+Revises: 7bae1953df5f
+Create Date: 2026-10-18 22:41:06.530127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d7a9e2b6f'
+down_revision = '7bae1953df5f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the home page is paged on (time_stamp, post_id), the index returns the rows of a user in that order
+    with op.batch_alter_table('timeline', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_user_id_time_stamp')
+        batch_op.create_index('ix_timeline_user_id_time_stamp', ['user_id', 'time_stamp', 'post_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('timeline', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_user_id_time_stamp')
+        batch_op.create_index('ix_timeline_user_id_time_stamp', ['user_id', 'time_stamp'], unique=False)
@@ -1,15 +1,68 @@
 import os
-
-os.environ["DATABASE_URL"] = "sqlite://"
-
 from datetime import datetime,timedelta
-from app import app, db
-from app.models import User,Post
+from app import create_app, db
+from config import Config
+from app.models import User,Post,load_user,user_cache,followed_cache,followers
+from app.pagination import keyset_paginate, decode_cursor
+from app.last_seen import last_seen_buffer
+from app.fragments import fragment_cache
+from app.hashing import HashingBusy, password_hasher
+from app.throttle import login_throttle
+from app.response_cache import ResponseCache, response_cache
+from app.log import DigestMailHandler, LogPipeline
+from app.search import Fts5Backend, LikeBackend, search
+from app.database import configure_engine
+from app.tasks import MemoryBackend, SqliteBackend, task_queue
 
+import json
+import logging
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
+from contextlib import contextmanager
+from email import message_from_bytes
+from email.policy import default as default_policy
+from logging.handlers import QueueHandler
+from flask import Flask, template_rendered
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import StaticPool
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # the last seen buffer is flushed explicitly by the tests
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    # a cheap hash keeps the tests fast
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:10000'
+    # background jobs run right after the commit that enqueues them
+    TASK_QUEUE = 'inline'
+    TASK_WORKERS = 0
+
+
+app = create_app(TestConfig)
+
+
+@contextmanager
+def count_queries(engine=None):
+    # collects the sql statements sent to the database inside the with block
+    engine = engine or db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
+        followed_cache.backend.clear()
         self.app_context = app.app_context()
         self.app_context.push()
         db.create_all()
@@ -31,6 +84,15 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_email_hash(self):
+        u = User(username='john', email='John@Example.com')
+        self.assertEqual(u.email_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.email_hash, 'f3fc30174d7fd74ab6ca3c36d198fcb9')
+        self.assertIn(u.email_hash, u.avatar(36))
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -92,5 +154,1357 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add_all([Post(body="first", author=u1),
+                            Post(body="second", author=u1)])
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual((u1.posts_count, u1.followed_count, u1.followers_count), (2, 1, 0))
+        self.assertEqual((u2.posts_count, u2.followed_count, u2.followers_count), (0, 0, 1))
+
+        u1.unfollow(u2)
+        db.session.delete(u1.posts.first())
+        db.session.commit()
+        self.assertEqual((u1.posts_count, u1.followed_count, u2.followers_count), (1, 0, 0))
+
+        # drifted counters are repaired by the rebuild command
+        u2.followers_count = 42
+        db.session.commit()
+        result = app.test_cli_runner().invoke(args=['counters', 'rebuild'])
+        self.assertIn('Counters rebuilt', result.output)
+        db.session.expire_all()
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u1.posts_count, 1)
+
+
+class TimelineCase(unittest.TestCase):
+    def setUp(self):
+        followed_cache.backend.clear()
+        app.config['TIMELINE_MATERIALIZED'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        app.config['TIMELINE_MATERIALIZED'] = False
+
+    def test_materialized_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1,
+                  time_stamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  time_stamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        # following backfills the posts written before the follow
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p2, p1])
+
+        # new posts are pushed to the followers
+        p3 = Post(body="post from susan", author=u2,
+                  time_stamp=now + timedelta(seconds=3))
+        p4 = Post(body="post from mary", author=u3,
+                  time_stamp=now + timedelta(seconds=4))
+        db.session.add_all([p3, p4])
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p2, p1])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p1])
+
+    def test_keyset_pages_of_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+        posts = [Post(body=f"post {i}", author=u2,
+                      time_stamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        query, key = u1.followed_posts_page()
+        first = keyset_paginate(query, 2, key=key)
+        second = keyset_paginate(query, 2, key=key,
+                                 before=decode_cursor(first.next_cursor))
+        last = keyset_paginate(query, 2, key=key,
+                               before=decode_cursor(second.next_cursor))
+        self.assertEqual(first.items + second.items + last.items,
+                         posts[::-1])
+
+        # the rows are read in the order of the timeline index, not sorted
+        statement = query.order_by(None).order_by(
+            key[0].desc(), key[1].desc()).limit(3).statement
+        sql = str(statement.compile(db.engine,
+                                    compile_kwargs={'literal_binds': True}))
+        plan = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql)).all()
+        self.assertFalse([row for row in plan if 'TEMP B-TREE' in row[-1]])
+
+    def test_celebrity_fan_out_on_read(self):
+        app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 1
+        try:
+            u1 = User(username='john', email='john@example.com')
+            u2 = User(username='susan', email='susan@example.com')
+            db.session.add_all([u1, u2])
+            db.session.commit()
+            u1.follow(u2)
+            db.session.commit()
+
+            p1 = Post(body="post from susan", author=u2)
+            db.session.add(p1)
+            db.session.commit()
+            # susan is past the threshold so her post is only in her own timeline and merged on read
+            self.assertEqual(u1.followed_posts().all(), [p1])
+            self.assertEqual(u2.followed_posts().all(), [p1])
+        finally:
+            app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 10000
+
+    def test_bulk_follow(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        p1 = Post(body="post from susan", author=u2)
+        p2 = Post(body="post from mary", author=u3)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        users = u1.follow_many(['susan', 'mary', 'john', 'nobody'])
+        db.session.commit()
+        self.assertEqual({u.username for u in users}, {'susan', 'mary'})
+        self.assertEqual(u1.followed_count, 2)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(set(u1.followed_posts().all()), {p1, p2})
+
+        # following again is a no-op
+        u1.follow_many(['susan'])
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 2)
+        self.assertEqual(u1.followed.count(), 2)
+
+        u1.unfollow_many(['susan'])
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u1.followed_posts().all(), [p2])
+
+
+class TaskQueueCase(unittest.TestCase):
+    def setUp(self):
+        followed_cache.backend.clear()
+        app.config['TIMELINE_MATERIALIZED'] = True
+        app.config['TASK_RETRY_DELAY'] = 0
+        self.folder = tempfile.TemporaryDirectory()
+        self.runs = []
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        task_queue.backend = None
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.folder.cleanup()
+        app.config['TIMELINE_MATERIALIZED'] = False
+        app.config['TASK_RETRY_DELAY'] = 1
+
+    def sqlite_backend(self):
+        return SqliteBackend(os.path.join(self.folder.name, 'tasks.db'), lease=60)
+
+    def flaky(self, failures):
+        # a task failing the first failures runs
+        @task_queue.task
+        def flaky_task(value):
+            self.runs.append(value)
+            if len(self.runs) <= failures:
+                raise RuntimeError('try again')
+
+    def test_post_fan_out_after_commit(self):
+        task_queue.backend = MemoryBackend()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        p1 = Post(body='post from susan', author=u2)
+        db.session.add(p1)
+        db.session.flush()
+        # nothing is enqueued before the commit
+        self.assertEqual(len(task_queue.backend), 0)
+        db.session.commit()
+        self.assertEqual(len(task_queue.backend), 1)
+        # the author sees the post at once, the follower once the job ran
+        self.assertEqual(u2.followed_posts().all(), [p1])
+        self.assertEqual(u1.followed_posts().all(), [])
+        task_queue.work(burst=True)
+        self.assertEqual(u1.followed_posts().all(), [p1])
+
+        # a job run twice does not push the post twice
+        task_queue.enqueue('fan_out_post', post_id=p1.id)
+        task_queue.work(burst=True)
+        self.assertEqual(u1.followed_posts().all(), [p1])
+
+        # a rolled back post enqueues nothing
+        db.session.add(Post(body='never posted', author=u2))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(len(task_queue.backend), 0)
+
+    def test_retries(self):
+        self.flaky(2)
+        task_queue.backend = MemoryBackend()
+        task_queue.enqueue('flaky_task', value=1)
+        task_queue.work(burst=True)
+        self.assertEqual(self.runs, [1, 1, 1])
+        self.assertEqual(len(task_queue.backend), 0)
+
+    def test_gives_up_after_max_attempts(self):
+        self.flaky(100)
+        task_queue.backend = self.sqlite_backend()
+        with self.assertLogs(app.logger, 'ERROR'):
+            task_queue.enqueue('flaky_task', value=1)
+            task_queue.work(burst=True)
+        self.assertEqual(len(self.runs), app.config['TASK_MAX_ATTEMPTS'])
+        self.assertEqual(len(task_queue.backend), 0)
+        row = task_queue.backend._connect().execute('SELECT failed, error FROM job').fetchone()
+        self.assertEqual(row, (1, "RuntimeError('try again')"))
+
+    def test_durable_queue_survives_restart(self):
+        self.flaky(0)
+        task_queue.backend = self.sqlite_backend()
+        task_queue.enqueue('flaky_task', value=1)
+        task_queue.enqueue('flaky_task', value=2)
+        # a worker claimed a job and died, the job runs again after its lease
+        claimed = task_queue.backend.claim(timeout=0)
+        self.assertEqual(claimed.payload, {'value': 1})
+
+        # a new process opens the same file
+        task_queue.backend = self.sqlite_backend()
+        task_queue.work(burst=True)
+        self.assertEqual(self.runs, [2])
+        task_queue.backend.lease = 0
+        task_queue.backend._connect().execute('UPDATE job SET claimed_until = 0')
+        task_queue.work(burst=True)
+        self.assertEqual(self.runs, [2, 1])
+        self.assertEqual(len(task_queue.backend), 0)
+
+    def test_worker_command(self):
+        self.flaky(0)
+        task_queue.backend = self.sqlite_backend()
+        task_queue.enqueue('flaky_task', value=1)
+        app.config['TASK_QUEUE'] = 'sqlite'
+        try:
+            result = app.test_cli_runner().invoke(args=['worker', '--burst'])
+        finally:
+            app.config['TASK_QUEUE'] = 'inline'
+        self.assertIn('Worker stopped', result.output)
+        self.assertEqual(self.runs, [1])
+
+
+class BulkFollowCase(unittest.TestCase):
+    def setUp(self):
+        followed_cache.backend.clear()
+        app.config['WTF_CSRF_ENABLED'] = False
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add_all([u] + [
+                User(username=name, email=f'{name}@example.com')
+                for name in ('susan', 'mary', 'david')
+            ])
+            db.session.commit()
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def test_endpoint(self):
+        client = app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        response = client.post('/follows', json={'usernames': ['susan', 'mary', 'nobody']})
+        self.assertEqual(response.get_json(), {
+            'usernames': ['mary', 'susan'], 'unknown': ['nobody'], 'followed_count': 2})
+        response = client.delete('/follows', json={'usernames': ['mary']})
+        self.assertEqual(response.get_json()['followed_count'], 1)
+        # form posts are refused so the endpoint can not be reached by a cross site form
+        response = client.post('/follows', data={'usernames': 'david'})
+        self.assertEqual(response.status_code, 400)
+        with app.app_context():
+            self.assertEqual(User.query.filter_by(username='susan').first().followers_count, 1)
+
+    def test_import_command(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'follows.csv')
+            with open(path, 'w') as file:
+                file.write('follower,followed\n')
+                file.write('john,susan\njohn,mary\nsusan,john\njohn,susan\nnobody,john\n')
+            result = app.test_cli_runner().invoke(
+                args=['follows', 'import', path, '--batch-size', '2'])
+        self.assertIn('Imported 4 follows, skipped 1', result.output)
+        with app.app_context():
+            john = User.query.filter_by(username='john').first()
+            self.assertEqual(john.followed_count, 2)
+            self.assertEqual(john.followers_count, 1)
+            self.assertEqual(john.followed.count(), 2)
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        followed_cache.backend.clear()
+        user_cache.backend.clear()
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['API_PER_PAGE'] = 2
+        with app.app_context():
+            db.create_all()
+            john = User(username='john', email='john@example.com')
+            john.set_password('cat')
+            susan = User(username='susan', email='susan@example.com', about_me='hi')
+            mary = User(username='mary', email='mary@example.com')
+            db.session.add_all([john, susan, mary])
+            db.session.commit()
+            now = datetime.utcnow()
+            for i, author in enumerate([john, susan, mary, susan, john]):
+                db.session.add(Post(body=f'post {i} from {author.username}', author=author,
+                                    time_stamp=now + timedelta(seconds=i)))
+            john.follow(susan)
+            mary.follow(susan)
+            db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['API_PER_PAGE'] = 25
+
+    def login(self):
+        self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+        with app.app_context():
+            self.engine = db.engine
+
+    def test_login_required(self):
+        response = self.client.get('/api/v1/timeline')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json(), {'error': 'authentication required'})
+        self.assertEqual(self.client.get('/api/v1/explore').status_code, 200)
+
+    def test_cursor_pagination(self):
+        self.login()
+        bodies, url = [], '/api/v1/timeline'
+        while url:
+            data = self.client.get(url).get_json()
+            self.assertLessEqual(len(data['items']), 2)
+            bodies.extend(item['body'] for item in data['items'])
+            url = data['next_cursor'] and f"/api/v1/timeline?cursor={data['next_cursor']}"
+        self.assertEqual(bodies, [
+            'post 4 from john', 'post 3 from susan', 'post 1 from susan', 'post 0 from john'])
+        response = self.client.get('/api/v1/explore?cursor=nonsense')
+        self.assertEqual(response.status_code, 400)
+
+    def test_materialized_timeline_pagination(self):
+        app.config['TIMELINE_MATERIALIZED'] = True
+        try:
+            with app.app_context():
+                ann = User(username='ann', email='ann@example.com')
+                ann.set_password('dog')
+                db.session.add(ann)
+                db.session.commit()
+                ann.follow(User.query.filter_by(username='susan').first())
+                db.session.commit()
+                engine = db.engine
+            self.client.post('/login', data={'username': 'ann', 'password': 'dog'})
+            bodies, url = [], '/api/v1/timeline?limit=1&fields=body'
+            with count_queries(engine) as statements:
+                while url:
+                    data = self.client.get(url).get_json()
+                    bodies.extend(item['body'] for item in data['items'])
+                    url = data['next_cursor'] and f"/api/v1/timeline?limit=1&fields=body&cursor={data['next_cursor']}"
+            self.assertEqual(bodies, ['post 3 from susan', 'post 1 from susan'])
+            # read in the order of the timeline index
+            query = [s for s in statements if 'JOIN timeline' in s][-1]
+            self.assertIn('ORDER BY timeline.time_stamp DESC, timeline.post_id DESC', query)
+        finally:
+            app.config['TIMELINE_MATERIALIZED'] = False
+
+    def test_fields(self):
+        self.login()
+        with count_queries(self.engine) as statements:
+            data = self.client.get('/api/v1/explore?fields=id,body&limit=1').get_json()
+        self.assertEqual(data['items'], [{'id': 5, 'body': 'post 4 from john'}])
+        # only the requested columns are read and the authors are not joined
+        query = [s for s in statements if 'FROM post' in s][-1]
+        self.assertNotIn('JOIN', query)
+        self.assertNotIn('post.user_id', query.split('FROM')[0])
+
+        data = self.client.get('/api/v1/users/susan?fields=username,about_me,posts_count').get_json()
+        self.assertEqual(data, {'username': 'susan', 'about_me': 'hi', 'posts_count': 2})
+        response = self.client.get('/api/v1/users/susan?fields=username,password_hash')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/users/nobody').status_code, 404)
+
+    def test_user_lists(self):
+        self.login()
+        data = self.client.get('/api/v1/users/susan/posts?fields=body').get_json()
+        self.assertEqual(data['items'], [{'body': 'post 3 from susan'}, {'body': 'post 1 from susan'}])
+        self.assertIsNone(data['next_cursor'])
+        data = self.client.get('/api/v1/users/susan/followers?fields=username').get_json()
+        self.assertEqual(data['items'], [{'username': 'john'}, {'username': 'mary'}])
+        data = self.client.get('/api/v1/users/john/followed').get_json()
+        self.assertEqual([item['username'] for item in data['items']], ['susan'])
+        self.assertTrue(data['items'][0]['avatar'].startswith('https://'))
+
+    def test_batch(self):
+        self.login()
+        with count_queries(self.engine) as statements:
+            response = self.client.post('/api/v1/batch', json={
+                'users': {'ids': [3, 1, 42], 'fields': ['id', 'username']},
+                'posts': {'ids': [2], 'fields': ['body', 'author']},
+            })
+        self.assertEqual(response.get_json(), {
+            'users': [{'id': 3, 'username': 'mary'}, {'id': 1, 'username': 'john'}],
+            'posts': [{'body': 'post 1 from susan', 'author': 'susan'}],
+        })
+        self.assertEqual(len([s for s in statements if 'WHERE' in s and ' IN ' in s]), 2)
+        response = self.client.post('/api/v1/batch', json={'users': {'ids': ['1']}})
+        self.assertEqual(response.status_code, 400)
+        for fields in (5, [['id']], {'id': 1}):
+            response = self.client.post('/api/v1/batch', json={
+                'users': {'ids': [1], 'fields': fields}})
+            self.assertEqual(response.status_code, 400)
+        app.config['API_BATCH_MAX'] = 2
+        try:
+            response = self.client.post('/api/v1/batch', json={'users': {'ids': [1, 2, 3]}})
+        finally:
+            app.config['API_BATCH_MAX'] = 100
+        self.assertEqual(response.status_code, 413)
+
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['EXPORT_BATCH_SIZE'] = 2
+        with app.app_context():
+            db.create_all()
+            admin = User(username='admin', email=app.config['ADMINS'][0])
+            admin.set_password('cat')
+            john = User(username='john', email='john@example.com')
+            john.set_password('dog')
+            now = datetime.utcnow()
+            db.session.add_all([admin, john] + [
+                Post(body=f'post {i}', author=john, time_stamp=now + timedelta(seconds=i))
+                for i in range(5)
+            ])
+            db.session.commit()
+            self.start = now
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['EXPORT_BATCH_SIZE'] = 1000
+
+    def get(self, username, password, url):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': password})
+        return client.get(url)
+
+    def test_streamed_export(self):
+        response = self.get('admin', 'cat', '/export/posts')
+        self.assertTrue(response.is_streamed)
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([row['body'] for row in rows], [f'post {i}' for i in range(5)])
+
+        # resuming from the cursor of the third row
+        response = self.get('admin', 'cat', '/export/posts?after=' + rows[2]['cursor'])
+        self.assertEqual(
+            [json.loads(line)['body'] for line in response.data.decode().splitlines()],
+            ['post 3', 'post 4'])
+
+        since = (self.start + timedelta(seconds=4)).isoformat()
+        response = self.get('admin', 'cat', '/export/posts?format=csv&since=' + since)
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], 'id,user_id,body,time_stamp,cursor')
+        self.assertEqual(len(lines), 2)
+
+        self.assertEqual(self.get('admin', 'cat', '/export/posts?after=nope').status_code, 400)
+        self.assertEqual(self.get('john', 'dog', '/export/posts').status_code, 403)
+
+    def test_export_command(self):
+        result = app.test_cli_runner().invoke(args=['export', 'users', '--format', 'csv'])
+        lines = result.output.splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertNotIn('hashed_password', lines[0])
+        self.assertTrue(lines[2].startswith('2,john,john@example.com'))
+
+
+class SearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        self.posts = [
+            Post(body='the quick brown fox', author=u),
+            Post(body='a lazy dog', author=u),
+            Post(body='quick quick, quick!', author=u),
+            Post(body='snake_case names', author=u),
+        ]
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        app.config['POSTS_PER_PAGE'] = 25
+
+    def test_fts5_ranked_pages(self):
+        self.assertIsInstance(search.backend, Fts5Backend)
+        fox, dog, quick, snake = self.posts
+        self.assertEqual(search.search('QUICK')[0], [quick, fox])
+        self.assertEqual(search.search('quick brown')[0], [fox])
+        # query syntax is not interpreted
+        self.assertEqual(search.search('quick" OR "dog')[0], [])
+
+        app.config['POSTS_PER_PAGE'] = 1
+        first, cursor = search.search('quick')
+        second, last = search.search('quick', cursor)
+        self.assertEqual((first, second, last), ([quick], [fox], None))
+
+        # the index follows the deletes
+        db.session.delete(fox)
+        db.session.commit()
+        self.assertEqual(search.search('fox'), ([], None))
+
+    def test_like_fallback(self):
+        backend = search.backend
+        search.backend = LikeBackend()
+        try:
+            fox, dog, quick, snake = self.posts
+            self.assertEqual(search.search('quick')[0], [quick, fox])
+            self.assertEqual(search.search('e_c')[0], [snake])
+            self.assertEqual(search.search('e c')[0], [snake, fox])
+        finally:
+            search.backend = backend
+
+    def test_reindex_command(self):
+        with db.engine.begin() as connection:
+            connection.execute(text("INSERT INTO post_fts (post_fts) VALUES ('delete-all')"))
+        self.assertEqual(search.search('fox')[0], [])
+        result = app.test_cli_runner().invoke(args=['search', 'reindex'])
+        self.assertIn('Search index rebuilt', result.output)
+        self.assertEqual(search.search('fox')[0], [self.posts[0]])
+
+
+class DatabaseProfileCase(unittest.TestCase):
+    def test_sqlite_pragmas(self):
+        with tempfile.TemporaryDirectory() as folder:
+            engine = create_engine('sqlite:///' + os.path.join(folder, 'profile.db'))
+            configure_engine(engine, app.config)
+            with engine.connect() as connection:
+                pragma = lambda name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+                self.assertEqual(pragma('journal_mode'), 'wal')
+                # 1 is NORMAL
+                self.assertEqual(pragma('synchronous'), 1)
+                self.assertEqual(pragma('busy_timeout'), app.config['SQLITE_BUSY_TIMEOUT_MS'])
+                self.assertEqual(pragma('cache_size'), -app.config['SQLITE_CACHE_SIZE_KB'])
+            engine.dispose()
+
+
+class ReplicaCase(unittest.TestCase):
+    # the replica is a second database that only has an older post, so the tests can tell which one was read
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['RESPONSE_CACHE_TTL'] = 0
+        fragment_cache.cache.clear()
+        user_cache.backend.clear()
+        self.replica = create_engine('sqlite://', poolclass=StaticPool,
+                                     connect_args={'check_same_thread': False})
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add_all([u, Post(body='primary post', author=u)])
+            db.session.commit()
+            db.metadata.create_all(self.replica)
+            with self.replica.begin() as connection:
+                users = db.session.execute(User.__table__.select()).mappings().all()
+                connection.execute(User.__table__.insert(), [dict(row) for row in users])
+                connection.execute(Post.__table__.insert(), {'id': 100, 'body': 'replica post', 'user_id': 1})
+            db.engines['replica'] = self.replica
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            del db.engines['replica']
+            db.drop_all()
+        self.replica.dispose()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['RESPONSE_CACHE_TTL'] = 5
+
+    def test_reads_go_to_the_replica(self):
+        response = app.test_client().get('/explore')
+        self.assertIn(b'replica post', response.data)
+        self.assertNotIn(b'primary post', response.data)
+
+    def test_writer_sticks_to_the_primary(self):
+        client = app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        self.assertIn(b'replica post', client.get('/index').data)
+
+        # the redirect after posting reads the new post from the primary
+        response = client.post('/index', data={'body': 'fresh post'}, follow_redirects=True)
+        self.assertIn(b'fresh post', response.data)
+        self.assertIn(b'primary post', client.get('/explore').data)
+
+        # once the lag window is over the reads go back to the replica
+        with client.session_transaction() as session:
+            session['_primary_until'] = 0
+        self.assertNotIn(b'fresh post', client.get('/index').data)
+
+
+class PaginationCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        # two posts share a time stamp so that the id has to break the tie
+        posts = [Post(body=f"post {i}", author=u1 if i % 2 else u2,
+                      time_stamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        expected = [posts[4], posts[3], posts[2], posts[1], posts[0]]
+
+        first = keyset_paginate(u1.followed_posts(), 2)
+        self.assertEqual(first.items, expected[:2])
+        self.assertFalse(first.has_prev)
+        second = keyset_paginate(u1.followed_posts(), 2,
+                                 before=decode_cursor(first.next_cursor))
+        self.assertEqual(second.items, expected[2:4])
+        last = keyset_paginate(u1.followed_posts(), 2,
+                               before=decode_cursor(second.next_cursor))
+        self.assertEqual(last.items, expected[4:])
+        self.assertIsNone(last.next_cursor)
+
+        back = keyset_paginate(u1.followed_posts(), 2,
+                               after=decode_cursor(last.prev_cursor))
+        self.assertEqual(back.items, expected[2:4])
+        self.assertTrue(back.has_prev)
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+
+
+class LastSeenCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_last_seen_is_written_in_bulk(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        then = datetime(2023, 5, 1)
+        now = datetime(2023, 5, 2)
+
+        last_seen_buffer.touch(u1.id, then)
+        last_seen_buffer.touch(u1.id, now)
+        last_seen_buffer.touch(u2.id, then)
+        # the buffered time is visible before it reaches the database
+        self.assertEqual(last_seen_buffer.last_seen(u1), now)
+        self.assertNotEqual(db.session.get(User, u1.id).last_seen, now)
+
+        with count_queries() as statements:
+            self.assertEqual(last_seen_buffer.flush(), 2)
+        self.assertEqual(
+            len([s for s in statements if s.startswith('UPDATE')]), 1)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, u1.id).last_seen, now)
+        self.assertEqual(db.session.get(User, u2.id).last_seen, then)
+
+
+class UserCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        # a dictionary stands in for the shared backend
+        self.backend = user_cache.backend
+        user_cache.backend = SharedCacheStandIn()
+
+    def tearDown(self):
+        user_cache.backend = self.backend
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_load_user_is_cached(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        id1, id2 = u1.id, u2.id
+        load_user(str(id1))
+        db.session.remove()
+
+        with count_queries() as statements:
+            user = load_user(str(id1))
+            self.assertEqual(user.username, 'john')
+        self.assertEqual(statements, [])
+
+        # changes invalidate the cached row once they are committed
+        user.set_password('cat')
+        user.follow(db.session.get(User, id2))
+        db.session.commit()
+        self.assertNotIn(id1, user_cache.backend.data)
+        self.assertNotIn(id2, user_cache.backend.data)
+        db.session.remove()
+        self.assertTrue(load_user(str(id1)).check_password('cat'))
+        self.assertIn(id1, user_cache.backend.data)
+
+
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['INSTRUMENTATION_ENABLED'] = True
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add_all([u, Post(body='hello', author=u)])
+            db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['INSTRUMENTATION_ENABLED'] = False
+
+    def test_server_timing_and_metrics(self):
+        response = self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+        self.assertRegex(response.headers['Server-Timing'], r'hash;dur=[1-9]')
+        response = self.client.get('/index')
+        timing = response.headers['Server-Timing']
+        self.assertRegex(timing, r'sql;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        self.assertRegex(timing, r'render;dur=[0-9.]+')
+
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_requests_total{endpoint="main.index",method="GET",status="200"} 1', metrics)
+        self.assertIn('microblog_request_duration_seconds_count{endpoint="main.login"} 1', metrics)
+
+        # statistics of the caches are exported too
+        self.assertIn('microblog_followed_cache_hit_rate ', metrics)
+
+        app.config['INSTRUMENTATION_ENABLED'] = False
+        self.assertNotIn('Server-Timing', self.client.get('/index').headers)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class FollowedCacheCase(unittest.TestCase):
+    def setUp(self):
+        followed_cache.backend.clear()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username=name, email=f'{name}@example.com')
+                      for name in ('john', 'susan', 'mary')]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        followed_cache.max_degree = app.config['FOLLOWED_CACHE_MAX_DEGREE']
+
+    def test_is_following_is_cached_and_coherent(self):
+        john, susan, mary = self.users
+        john.follow(susan)
+        db.session.commit()
+        self.assertTrue(john.is_following(susan))
+        # the users are expired by the commit, load them before counting
+        [user.id for user in self.users]
+        with count_queries() as statements:
+            self.assertTrue(john.is_following(susan))
+            self.assertFalse(john.is_following(mary))
+        self.assertEqual(statements, [])
+
+        # inside the transaction of a change the database is read, after its commit the cache is up to date
+        john.unfollow(susan)
+        john.follow(mary)
+        self.assertFalse(john.is_following(susan))
+        self.assertTrue(john.is_following(mary))
+        db.session.commit()
+        self.assertEqual((john.is_following(susan), john.is_following(mary)), (False, True))
+
+        john.unfollow_many(['mary'])
+        db.session.commit()
+        self.assertFalse(john.is_following(mary))
+
+    def test_stale_cache_does_not_break_follow(self):
+        john, susan, mary = self.users
+        self.assertFalse(john.is_following(susan))
+        # another worker follows susan, the cache of this one still says no
+        db.session.execute(followers.insert().values(follower_id=john.id, followed_id=susan.id))
+        db.session.commit()
+        self.assertFalse(john.is_following(susan))
+        john.follow(susan)
+        db.session.commit()
+        self.assertEqual(john.followed.count(), 1)
+
+        john.follow(mary)
+        db.session.commit()
+        self.assertTrue(john.is_following(mary))
+        # and unfollows mary
+        db.session.execute(followers.delete().where(followers.c.followed_id == mary.id))
+        db.session.commit()
+        self.assertTrue(john.is_following(mary))
+        john.unfollow(mary)
+        db.session.commit()
+        self.assertEqual(john.followed.all(), [susan])
+
+    def test_users_with_many_follows_are_not_cached(self):
+        john, susan, mary = self.users
+        followed_cache.max_degree = 1
+        john.follow_many(['susan', 'mary'])
+        db.session.commit()
+        uncached = followed_cache.stats()['uncached']
+        self.assertTrue(john.is_following(susan))
+        self.assertFalse(susan.is_following(john))
+        self.assertEqual(followed_cache.stats()['uncached'], uncached + 1)
+
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        # the ids of the posts are reused from one test database to the next
+        fragment_cache.cache.clear()
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add(u)
+            db.session.add_all([Post(body=f'post {i}', author=u) for i in range(3)])
+            db.session.commit()
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def rendered_posts(self, url):
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            if template.name == '_post.html':
+                rendered.append(context['post'].id)
+
+        with template_rendered.connected_to(record, app):
+            response = self.client.get(url)
+        return response, rendered
+
+    def test_post_fragments_are_cached(self):
+        response, rendered = self.rendered_posts('/user/john')
+        self.assertEqual(len(rendered), 3)
+        cached, rendered = self.rendered_posts('/user/john')
+        self.assertEqual(rendered, [])
+        self.assertEqual(cached.data.count(b'john says:'), 3)
+
+        # editing the profile changes the author version so the posts are rendered again
+        self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': ''})
+        response, rendered = self.rendered_posts('/user/johnny')
+        self.assertEqual(len(rendered), 3)
+        self.assertEqual(response.data.count(b'johnny says:'), 3)
+
+
+class LoginHashingCase(unittest.TestCase):
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add(u)
+            db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        login_throttle.reset('username:john')
+        login_throttle.reset('ip:127.0.0.1')
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def login(self, password):
+        return self.client.post('/login', data={'username': 'john', 'password': password})
+
+    def test_failed_logins_are_throttled(self):
+        for _ in range(app.config['LOGIN_ATTEMPTS_PER_USERNAME']):
+            self.assertEqual(self.login('dog').status_code, 302)
+        # the right password is refused too until the window is over
+        self.assertEqual(self.login('cat').status_code, 429)
+
+    def test_password_is_rehashed_on_login(self):
+        method = app.config['PASSWORD_HASH_METHOD']
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        try:
+            self.assertEqual(self.login('cat').status_code, 302)
+            with app.app_context():
+                hashed_password = User.query.first().hashed_password
+            self.assertTrue(hashed_password.startswith('pbkdf2:sha256:1000$'))
+        finally:
+            app.config['PASSWORD_HASH_METHOD'] = method
+
+    def test_saturated_hashing_pool_answers_503(self):
+        workers = app.config['HASH_POOL_WORKERS']
+        app.config['HASH_POOL_WORKERS'] = 1
+        executor, slots = password_hasher._pool()
+        taken = 0
+        while slots.acquire(blocking=False):
+            taken += 1
+        try:
+            response = self.login('cat')
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response.headers)
+        finally:
+            for _ in range(taken):
+                slots.release()
+            app.config['HASH_POOL_WORKERS'] = workers
+
+
+    def test_dead_hashing_process_is_replaced(self):
+        workers = app.config['HASH_POOL_WORKERS']
+        app.config['HASH_POOL_WORKERS'] = 1
+        try:
+            with app.app_context():
+                # the pool process exits in the middle of a call like a killed one
+                with self.assertRaises(HashingBusy):
+                    password_hasher.run(os._exit, 1)
+            self.assertEqual(self.login('cat').status_code, 302)
+        finally:
+            password_hasher.shutdown()
+            app.config['HASH_POOL_WORKERS'] = workers
+
+class ConditionalGetCase(unittest.TestCase):
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        # the etags are tested without the anonymous page cache in front of the views
+        app.config['RESPONSE_CACHE_TTL'] = 0
+        with app.app_context():
+            db.create_all()
+            u1 = User(username='john', email='john@example.com')
+            u2 = User(username='susan', email='susan@example.com')
+            u1.set_password('cat')
+            db.session.add_all([u1, u2, Post(body='hello', author=u2)])
+            db.session.commit()
+            self.engine = db.engine
+        self.client = app.test_client()
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['RESPONSE_CACHE_TTL'] = 5
+
+    def test_anonymous_explore(self):
+        response = self.client.get('/explore')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.cache_control.public)
+        etag = response.headers['ETag']
+
+        with count_queries(self.engine) as statements:
+            response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # the page and its authors, the same statements as a full response
+        self.assertEqual(len(statements), 2)
+        with count_queries(self.engine) as statements:
+            self.assertEqual(self.client.get('/explore').status_code, 200)
+        self.assertEqual(len(statements), 2)
+
+        with app.app_context():
+            db.session.add(Post(body='news', author=User.query.first()))
+            db.session.commit()
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_explore_changes_with_author_rename(self):
+        etag = self.client.get('/explore').headers['ETag']
+        author = app.test_client()
+        with app.app_context():
+            User.query.filter_by(username='susan').first().set_password('dog')
+            db.session.commit()
+        author.post('/login', data={'username': 'susan', 'password': 'dog'})
+        author.post('/edit_profile', data={'username': 'sue', 'about_me': ''})
+
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'sue', response.data)
+
+    def test_profile_changes_with_follow(self):
+        self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+        response = self.client.get('/user/susan')
+        self.assertTrue(response.cache_control.private)
+        etag = response.headers['ETag']
+        response = self.client.get('/user/susan', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.post('/follow/susan')
+        self.client.get('/user/susan')  # shows the flashed message
+        response = self.client.get('/user/susan', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+
+class ResponseCacheCase(unittest.TestCase):
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        response_cache.clear()
+        fragment_cache.cache.clear()
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add_all([u, Post(body='hello', author=u)])
+            db.session.commit()
+            self.engine = db.engine
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        response_cache.clear()
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def test_anonymous_explore_is_cached(self):
+        anonymous = app.test_client()
+        first = anonymous.get('/explore')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        with count_queries(self.engine) as statements:
+            second = anonymous.get('/explore')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(statements, [])
+
+        # logged in users are never served from the cache
+        author = app.test_client()
+        author.post('/login', data={'username': 'john', 'password': 'cat'})
+        self.assertNotIn('X-Cache', author.get('/explore').headers)
+
+        # a new post drops the cached first page
+        author.post('/index', data={'body': 'news'})
+        third = anonymous.get('/explore')
+        self.assertEqual(third.headers['X-Cache'], 'MISS')
+        self.assertIn(b'news', third.data)
+
+    def test_concurrent_misses_render_once(self):
+        cache = ResponseCache(app)
+        calls = []
+        pages = []
+
+        def view():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'page'
+
+        cached_view = cache.cached(view)
+
+        def get():
+            with app.test_request_context('/explore'):
+                pages.append(cached_view().get_data())
+
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(pages, [b'page'] * 5)
+
+    def test_stale_page_is_served_while_refreshed(self):
+        ttl = app.config['RESPONSE_CACHE_TTL']
+        app.config['RESPONSE_CACHE_TTL'] = 0.05
+        try:
+            cache = ResponseCache(app)
+            calls = []
+            cached_view = cache.cached(lambda: 'page %d' % len(calls.append(1) or calls))
+            with app.test_request_context('/explore'):
+                self.assertEqual(cached_view().get_data(), b'page 1')
+            time.sleep(0.1)
+            with app.test_request_context('/explore'):
+                response = cached_view()
+            self.assertEqual(response.headers['X-Cache'], 'STALE')
+            self.assertEqual(response.get_data(), b'page 1')
+            for _ in range(50):
+                if len(calls) == 2:
+                    break
+                time.sleep(0.01)
+            with app.test_request_context('/explore'):
+                self.assertEqual(cached_view().get_data(), b'page 2')
+        finally:
+            app.config['RESPONSE_CACHE_TTL'] = ttl
+
+
+class SharedCacheStandIn:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    # a local smtp server keeping the messages it receives
+    daemon_threads = True
+
+    def __init__(self):
+        self.messages = []
+        super().__init__(('127.0.0.1', 0), SMTPStandInHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.reply('220 stand-in')
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command == 'DATA':
+                self.reply('354 end with .')
+                lines = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                self.server.messages.append(message_from_bytes(b''.join(lines), policy=default_policy))
+                self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text):
+        self.wfile.write(text.encode() + b'\r\n')
+
+
+class LoggingCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = SMTPStandIn()
+        self.logger = logging.getLogger('microblog.test')
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.handlers.clear()
+        self.smtp.stop()
+
+    def test_error_storm_is_mailed_as_one_digest(self):
+        pipeline = LogPipeline()
+        mail_handler = DigestMailHandler(
+            self.smtp.server_address, 'no-reply@example.com', ['admin@example.com'],
+            'Microblog Failure', interval=60)
+        pipeline.start(self.logger, [mail_handler])
+        start = time.perf_counter()
+        for i in range(20):
+            try:
+                raise ValueError(i)
+            except ValueError:
+                self.logger.exception('Exception on /user/%d [GET]', i)
+        try:
+            {}['missing']
+        except KeyError:
+            self.logger.exception('Exception on /index [GET]')
+        # the records are only queued, no smtp connection is made by the logging thread
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(self.smtp.messages, [])
+
+        pipeline.stop()
+        self.assertEqual(len(self.smtp.messages), 1)
+        message = self.smtp.messages[0]
+        self.assertEqual(message['Subject'], 'Microblog Failure (21 errors)')
+        body = message.get_content()
+        self.assertIn('20 x Exception on /user/0 [GET]', body)
+        self.assertIn('1 x Exception on /index [GET]', body)
+        self.assertIn('KeyError', body)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_forked_worker_logs(self):
+        # a worker forked from a preloaded master has no listener thread until it logs
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'microblog.log')
+            pipeline = LogPipeline()
+            pipeline.start(self.logger, [logging.FileHandler(path)])
+            self.logger.error('from the master')
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.logger.error('from the worker')
+                    pipeline.stop()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            pipeline.stop()
+            with open(path) as file:
+                lines = file.read().splitlines()
+        self.assertEqual(sorted(lines), ['from the master', 'from the worker'])
+
+    def test_app_logger_is_queued(self):
+        # create_app installs the pipeline outside of debug and testing, here on an app of its own
+        with tempfile.TemporaryDirectory() as folder:
+            other = Flask('microblog_logging_test')
+            other.config.from_object(TestConfig)
+            other.config['LOG_DIR'] = folder
+            pipeline = LogPipeline()
+            pipeline.init_app(other)
+            try:
+                self.assertTrue(any(isinstance(handler, QueueHandler) for handler in other.logger.handlers))
+                file_handler = pipeline.handlers[-1]
+                self.assertEqual(file_handler.maxBytes, app.config['LOG_MAX_BYTES'])
+                self.assertEqual(file_handler.backupCount, app.config['LOG_BACKUP_COUNT'])
+            finally:
+                pipeline.stop()
+
+
+class QueryCountCase(unittest.TestCase):
+    # requests run in their own app context like in production, so no context is kept pushed here
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        followed_cache.backend.clear()
+        with app.app_context():
+            db.create_all()
+            self.engine = db.engine
+        self.client = app.test_client()
+
+    def tearDown(self):
+        last_seen_buffer.flush(app)
+        with app.app_context():
+            db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def assertQueryCountConstant(self, url, add_authors):
+        # the number of queries of a page must not depend on how many authors it shows
+        self.client.get(url)
+        with count_queries(self.engine) as few:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        add_authors()
+        self.client.get(url)
+        with count_queries(self.engine) as many:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(len(few), len(many), many)
+
+    def test_post_pages_load_authors_in_batch(self):
+        counter = iter(range(100))
+
+        def add_authors(n=10):
+            with app.app_context():
+                reader = User.query.filter_by(username='reader').first()
+                for _ in range(n):
+                    i = next(counter)
+                    author = User(username=f'author{i}', email=f'author{i}@example.com')
+                    db.session.add(Post(body=f'post {i}', author=author))
+                    db.session.add(Post(body=f'post from reader {i}', author=reader))
+                    reader.follow(author)
+                db.session.commit()
+
+        with app.app_context():
+            reader = User(username='reader', email='reader@example.com')
+            reader.set_password('cat')
+            db.session.add(reader)
+            db.session.commit()
+        add_authors(2)
+        self.client.post('/login', data={'username': 'reader', 'password': 'cat'})
+        self.assertQueryCountConstant('/explore', add_authors)
+        self.assertQueryCountConstant('/index', add_authors)
+        self.assertQueryCountConstant('/user/reader', add_authors)
+
+
+class AppFactoryCase(unittest.TestCase):
+    def test_apps_keep_their_own_settings(self):
+        class OtherConfig(TestConfig):
+            TASK_QUEUE = 'memory'
+            SEARCH_BACKEND = 'like'
+        other = create_app(OtherConfig)
+        # creating another app does not change the extensions of the first one
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            db.session.add(u)
+            db.session.commit()
+            self.assertIsNone(task_queue.backend)
+            self.assertIsInstance(search.backend, Fts5Backend)
+            last_seen_buffer.touch(u.id)
+            with other.app_context():
+                self.assertIsInstance(task_queue.backend, MemoryBackend)
+                self.assertIsInstance(search.backend, LikeBackend)
+                self.assertIsNone(last_seen_buffer.get(u.id))
+            self.assertEqual(last_seen_buffer.flush(), 1)
+            db.session.remove()
+            db.drop_all()
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file